@@ -1,2 +1,2 @@
 from .encode_lenses import encode_examples
-from .decode_lenses import decode_all, decode_train, decode_physical_model_info, decode_results
\ No newline at end of file
+from .decode_lenses import parse_example, decode_image, decode_all, decode_train, decode_physical_model_info, decode_results
\ No newline at end of file
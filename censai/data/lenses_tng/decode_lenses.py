@@ -1,8 +1,11 @@
 import tensorflow as tf
 
 
-def decode_all(record_bytes):
-    example = tf.io.parse_single_example(
+def parse_example(record_bytes):
+    """
+    Parse a record without decoding the image fields, which are left as raw bytes strings.
+    """
+    return tf.io.parse_single_example(
           # Data
           record_bytes,
           # Schema
@@ -21,15 +24,35 @@ def decode_all(record_bytes):
               'noise rms': tf.io.FixedLenFeature([], tf.float32),
               "psf": tf.io.FixedLenFeature([], tf.string),
               "psf pixels":  tf.io.FixedLenFeature([], tf.int64),
-              "fwhm": tf.io.FixedLenFeature([], tf.float32)
+              "fwhm": tf.io.FixedLenFeature([], tf.float32),
+              # records written before image quantization was introduced are float32
+              "dtype": tf.io.FixedLenFeature([], tf.int64, default_value=tf.float32.as_datatype_enum)
           })
-    kappa = tf.io.decode_raw(example['kappa'], tf.float32)
-    source = tf.io.decode_raw(example['source'], tf.float32)
-    lens = tf.io.decode_raw(example['lens'], tf.float32)
+
+
+def decode_image(image_bytes, dtype):
+    """
+    Decode a flattened image stored in float32, float16 or bfloat16 (given by its datatype enum). Images are
+    always returned in float32.
+    """
+    def decode_half(half_dtype):
+        return lambda: tf.cast(tf.bitcast(tf.io.decode_raw(image_bytes, tf.uint16), half_dtype), tf.float32)
+    return tf.case(
+        [(tf.equal(dtype, tf.float16.as_datatype_enum), decode_half(tf.float16)),
+         (tf.equal(dtype, tf.bfloat16.as_datatype_enum), decode_half(tf.bfloat16))],
+        default=lambda: tf.io.decode_raw(image_bytes, tf.float32)
+    )
+
+
+def decode_all(record_bytes):
+    example = parse_example(record_bytes)
+    kappa = decode_image(example['kappa'], example['dtype'])
+    source = decode_image(example['source'], example['dtype'])
+    lens = decode_image(example['lens'], example['dtype'])
     kappa_pixels = example['kappa pixels']
     source_pixels = example['src pixels']
     pixels = example['pixels']
-    psf = tf.io.decode_raw(example['psf'], tf.float32)
+    psf = decode_image(example['psf'], example['dtype'])
     psf_pixels = example['psf pixels']
 
     example['kappa'] = tf.reshape(kappa, [kappa_pixels, kappa_pixels, 1])
@@ -1,5 +1,5 @@
 import tensorflow as tf
-from censai.models.utils import get_activation
+from censai.models.utils import get_activation_function, fuse_conv_batch_norm
 
 
 class DownsamplingLayer(tf.keras.layers.Layer):
@@ -20,15 +20,24 @@ class DownsamplingLayer(tf.keras.layers.Layer):
             padding="SAME",
             data_format="channels_last"
         )
-        self.batch_norm = tf.keras.layers.BatchNormalization() if batch_norm else tf.keras.layers.Lambda(lambda x, training=True: x)
+        self.batch_norm = tf.keras.layers.BatchNormalization() if batch_norm else None
         self.activation = activation
 
     def call(self, x, training=True):
         x = self.conv(x, training=training)
-        x = self.batch_norm(x, training=training)
+        if self.batch_norm is not None:
+            x = self.batch_norm(x, training=training)
         x = self.activation(x)
         return x
 
+    def fuse_bn(self):
+        """
+        Fold batch normalization into the convolution for inference. The layer must have been built.
+        """
+        if self.batch_norm is not None:
+            fuse_conv_batch_norm(self.conv, self.batch_norm)
+            self.batch_norm = None
+
 
 class ConvEncodingLayer(tf.keras.layers.Layer):
     def __init__(
@@ -57,7 +66,7 @@ class ConvEncodingLayer(tf.keras.layers.Layer):
         self.num_conv_layers = conv_layers
         self.filters = filters
         self.strides = tuple([strides]*2) if isinstance(strides, int) else strides
-        self.activation = get_activation(activation)
+        self.activation = get_activation_function(activation)  # resolved once, called without Keras dispatch
 
         self.conv_layers = []
         self.batch_norms = []
@@ -70,14 +79,10 @@ class ConvEncodingLayer(tf.keras.layers.Layer):
                     data_format="channels_last",
                 )
             )
-            if batch_norm:
-                self.batch_norms.append(
-                    tf.keras.layers.BatchNormalization()
-                )
-            else:
-                self.batch_norms.append(
-                    tf.keras.layers.Lambda(lambda x, training=True: x)
-                )
+            # None stands for a missing batch norm, so it is not traced at all in the forward pass
+            self.batch_norms.append(
+                tf.keras.layers.BatchNormalization() if batch_norm else None
+            )
         self.downsampling_layer = DownsamplingLayer(
             filters=self.downsampling_filters,
             kernel_size=self.downsampling_kernel_size,
@@ -87,24 +92,42 @@ class ConvEncodingLayer(tf.keras.layers.Layer):
         )
 
         if dropout_rate is None:
-            self.dropout = tf.keras.layers.Lambda(lambda x, training=True: x)
+            self.dropout = None
         else:
             self.dropout = tf.keras.layers.SpatialDropout2D(rate=dropout_rate, data_format="channels_last")
+        self._compile_forward_pass()
 
-    def call(self, x, training=True):
-        for i, layer in enumerate(self.conv_layers):
-            x = layer(x, training=training)
-            x = self.batch_norms[i](x, training=training)
-            x = self.activation(x, training=training)
-            x = self.dropout(x, training=training)
-        x = self.downsampling_layer(x, training=training)
-        return x
+    def _compile_forward_pass(self):
+        # XLA fuses the conv epilogues (bias, batch norm, activation, dropout) of the whole block. training is kept
+        # a python bool so train and eval get their own specialized graph. Must be called again whenever
+        # the sub-layers are swapped (e.g. by fuse_bn), since traces hold on to the layers they were built with.
+        self._forward = tf.function(self._forward_pass, experimental_compile=True)
 
-    def call_with_skip_connection(self, x, training=True):
+    def _forward_pass(self, x, training=True):
         for i, layer in enumerate(self.conv_layers):
             x = layer(x, training=training)
-            x = self.batch_norms[i](x, training=training)
+            if self.batch_norms[i] is not None:
+                x = self.batch_norms[i](x, training=training)
             x = self.activation(x)
-            x = self.dropout(x, training=training)
+            if self.dropout is not None:
+                x = self.dropout(x, training=training)
         x_down = self.downsampling_layer(x, training=training)
         return x, x_down
+
+    def call(self, x, training=True):
+        _, x_down = self._forward(x, training=training)
+        return x_down
+
+    def call_with_skip_connection(self, x, training=True):
+        return self._forward(x, training=training)
+
+    def fuse_bn(self):
+        """
+        Fold batch normalization into the convolutions for inference. The layer must have been built.
+        """
+        for i, layer in enumerate(self.conv_layers):
+            if self.batch_norms[i] is not None:
+                fuse_conv_batch_norm(layer, self.batch_norms[i])
+                self.batch_norms[i] = None
+        self.downsampling_layer.fuse_bn()
+        self._compile_forward_pass()
@@ -13,6 +13,7 @@ class ConvGRUPlusBlock(tf.keras.Model):
     ):
         super(ConvGRUPlusBlock, self).__init__()
         kernel_size = (kernel_size,)*2 if isinstance(kernel_size, int) else kernel_size
+        self.filters = filters
         self.conv1 = tf.keras.layers.Conv2D(
             filters=filters,
             kernel_size=kernel_size,
@@ -24,11 +25,18 @@ class ConvGRUPlusBlock(tf.keras.Model):
         self.gru1 = ConvGRUPlus(filters, kernel_size)
         self.gru2 = ConvGRUPlus(filters, kernel_size)
 
+    def build(self, input_shape):
+        self.conv1.build(tf.TensorShape([None, None, None, self.filters]))
+
+    def apply_conv1(self, x):
+        x = tf.nn.conv2d(x, self.conv1.kernel, strides=1, padding="SAME", data_format="NHWC")
+        return tf.nn.tanh(tf.nn.bias_add(x, self.conv1.bias, data_format="NHWC"))
+
+    @tf.function(experimental_compile=True)
     def call(self, inputs, state):
-        ht_11, ht_12 = tf.split(state, 2, axis=3)
+        ht_11, ht_12 = state
         gru_1_out, _ = self.gru1(inputs, ht_11)
-        gru_1_outE = self.conv1(gru_1_out)
+        gru_1_outE = self.apply_conv1(gru_1_out)
         gru_2_out, _ = self.gru2(gru_1_outE, ht_12)
-        ht = tf.concat([gru_1_out, gru_2_out], axis=3)
         xt = gru_2_out
-        return xt, ht
\ No newline at end of file
+        return xt, (gru_1_out, gru_2_out)
\ No newline at end of file
@@ -4,11 +4,9 @@ from censai.definitions import DTYPE
 
 class ConvGRUPlusHighway(tf.keras.layers.Layer):
     def __init__(self, filters=32, kernel_size=5, **kwargs):
-        super(ConvGRUPlusHighway, self).__init__(dtype=DTYPE, **kwargs)
+        super(ConvGRUPlusHighway, self).__init__(**kwargs)
         self.filters = filters
         self.kernel_size = (kernel_size,)*2 if isinstance(kernel_size, int) else kernel_size
-
-    def build(self, input_shape):
         self.w_z = tf.keras.layers.Conv2D(
             filters=self.filters,
             kernel_size=self.kernel_size,
@@ -25,7 +23,6 @@ class ConvGRUPlusHighway(tf.keras.layers.Layer):
             data_format="channels_last",
             use_bias=False
         )
-        self.bias_z = tf.Variable(tf.zeros(shape=input_shape[1:], dtype=DTYPE))
 
         self.w_r = tf.keras.layers.Conv2D(
             filters=self.filters,
@@ -43,7 +40,6 @@ class ConvGRUPlusHighway(tf.keras.layers.Layer):
             data_format="channels_last",
             use_bias=False
         )
-        self.bias_r = tf.Variable(tf.zeros(shape=input_shape[1:], dtype=DTYPE))
 
         self.w_h = tf.keras.layers.Conv2D(
             filters=self.filters,
@@ -61,7 +57,6 @@ class ConvGRUPlusHighway(tf.keras.layers.Layer):
             data_format="channels_last",
             use_bias=False
         )
-        self.bias_h = tf.Variable(tf.zeros(shape=input_shape[1:], dtype=DTYPE))
 
         self.w_g = tf.keras.layers.Conv2D(
             filters=self.filters,
@@ -79,16 +74,21 @@ class ConvGRUPlusHighway(tf.keras.layers.Layer):
             data_format="channels_last",
             use_bias=False
         )
+
+    def build(self, input_shape):
+        self.bias_z = tf.Variable(tf.zeros(shape=input_shape[1:], dtype=DTYPE))
+        self.bias_r = tf.Variable(tf.zeros(shape=input_shape[1:], dtype=DTYPE))
+        self.bias_h = tf.Variable(tf.zeros(shape=input_shape[1:], dtype=DTYPE))
         self.bias_g = tf.Variable(tf.zeros(shape=input_shape[1:], dtype=DTYPE))
 
     def call(self, x, ht):
         """
         Compute the new state tensor h_{t+1}.
         """
-        z = tf.nn.sigmoid(self.w_z(x) + self.u_z(ht) + self.bias_z)  # update gate
-        r = tf.nn.sigmoid(self.w_r(x) + self.u_r(ht) + self.bias_r)  # reset gate
-        h_tilde = tf.nn.tanh(self.w_h(x) + self.u_h(r * ht) + self.bias_h)  # candidate activation
+        z = tf.nn.sigmoid(self.w_z(x) + self.u_z(ht) + tf.cast(self.bias_z, self.compute_dtype))  # update gate
+        r = tf.nn.sigmoid(self.w_r(x) + self.u_r(ht) + tf.cast(self.bias_r, self.compute_dtype))  # reset gate
+        h_tilde = tf.nn.tanh(self.w_h(x) + self.u_h(r * ht) + tf.cast(self.bias_h, self.compute_dtype))  # candidate activation
         new_state = (1 - z) * ht + z * h_tilde
-        g = tf.nn.sigmoid(self.w_g(x) + self.u_g(ht) + self.bias_g)  # highway gate
+        g = tf.nn.sigmoid(self.w_g(x) + self.u_g(ht) + tf.cast(self.bias_g, self.compute_dtype))  # highway gate
         new_state = (1 - g) * x + g * new_state
         return new_state, new_state  # h_{t+1}
@@ -25,10 +25,9 @@ class ConvGRUPlusHighwayBlock(tf.keras.Model):
         self.gru2 = ConvGRUPlusHighway(filters, kernel_size)
 
     def call(self, inputs, state):
-        ht_11, ht_12 = tf.split(state, 2, axis=3)
+        ht_11, ht_12 = state
         gru_1_out, _ = self.gru1(inputs, ht_11)
         gru_1_outE = self.conv1(gru_1_out)
         gru_2_out, _ = self.gru2(gru_1_outE, ht_12)
-        ht = tf.concat([gru_1_out, gru_2_out], axis=3)
         xt = gru_2_out
-        return xt, ht
\ No newline at end of file
+        return xt, (gru_1_out, gru_2_out)
\ No newline at end of file
@@ -1,6 +1,5 @@
 import tensorflow as tf
 from censai.models.utils import get_activation
-from censai.definitions import DTYPE
 
 
 class UpsamplingLayer(tf.keras.layers.Layer):
@@ -49,7 +48,7 @@ class UnetDecodingLayer(tf.keras.layers.Layer):
             bilinear=False,  # whether to use bilinear upsampling or vanilla half strid convolution
             **common_params
     ):
-        super(UnetDecodingLayer, self).__init__(name=name, dtype=DTYPE)
+        super(UnetDecodingLayer, self).__init__(name=name)
         self.kernel_size = (kernel_size,)*2 if isinstance(kernel_size, int) else kernel_size
         if upsampling_kernel_size is None:
             self.upsampling_kernel_size = self.kernel_size
@@ -1,6 +1,5 @@
 import tensorflow as tf
 from censai.models.utils import get_activation
-from censai.definitions import DTYPE
 
 
 class DownsamplingLayer(tf.keras.layers.Layer):
@@ -50,7 +49,7 @@ class UnetEncodingLayer(tf.keras.layers.Layer):
             strides=2,     # for final layer
             **kwargs
     ):
-        super(UnetEncodingLayer, self).__init__(name=name, dtype=DTYPE)
+        super(UnetEncodingLayer, self).__init__(name=name)
         self.kernel_size = (kernel_size,)*2 if isinstance(kernel_size, int) else kernel_size
         if downsampling_kernel_size is None:
             self.downsampling_kernel_size = self.kernel_size
@@ -107,10 +107,13 @@ class Model(tf.keras.Model):
             kernel_size=bottleneck_kernel_size
         )
 
+        # Input and output layers always compute in DTYPE under a mixed precision policy. Likelihood gradients fed
+        # to the input layer can overflow float16, and the RIM updates stay in full precision
         self.output_layer = tf.keras.layers.Conv2D(
             filters=2,  # source and kappa
             kernel_size=(1, 1),
             activation="linear",
+            dtype=DTYPE,
             **common_params
         )
 
@@ -118,6 +121,7 @@ class Model(tf.keras.Model):
             filters=filters,
             kernel_size=input_kernel_size,
             activation=activation,
+            dtype=DTYPE,
             **common_params
         )
 
@@ -147,10 +151,10 @@ class Model(tf.keras.Model):
             pixels = input_pixels // self._strides**(i)
             filters = min(self.filter_cap, int(self._filter_scaling**(i) * self._init_filters))
             hidden_states.append(
-                tf.zeros(shape=[batch_size, pixels, pixels, filters], dtype=DTYPE)
+                tf.zeros(shape=[batch_size, pixels, pixels, filters], dtype=self.compute_dtype)
             )
         pixels = input_pixels // self._strides ** (self._num_layers)
         hidden_states.append(
-            tf.zeros(shape=[batch_size, pixels, pixels, min(self.filter_cap, int(self._init_filters * self._filter_scaling**(self._num_layers)))], dtype=DTYPE)
+            tf.zeros(shape=[batch_size, pixels, pixels, min(self.filter_cap, int(self._init_filters * self._filter_scaling**(self._num_layers)))], dtype=self.compute_dtype)
         )
         return hidden_states
@@ -27,3 +27,33 @@ def get_activation(activation_name, alpha=0.3):
         return tf.keras.layers.Lambda(lambda x: bipolar_relu(x))
     else:
         return tf.keras.layers.Activation(activation_name)
+
+
+def get_activation_function(activation_name, alpha=0.3):
+    """
+    Same as get_activation, but resolves the activation to a plain function instead of a Keras layer, so that calling it
+    inside a loop does not dispatch through Layer.__call__.
+    """
+    if activation_name == "leaky_relu":
+        return lambda x: tf.nn.leaky_relu(x, alpha=alpha)
+    elif activation_name == "bipolar_elu":
+        return bipolar_elu
+    elif activation_name == "bipolar_leaky_relu":
+        return lambda x: bipolar_leaky_relu(x, alpha=alpha)
+    elif activation_name == "bipolar_relu":
+        return bipolar_relu
+    else:
+        return tf.keras.activations.get(activation_name)
+
+
+def fuse_conv_batch_norm(conv, batch_norm):
+    """
+    Fold the moving statistics of a BatchNormalization layer into the kernel and bias of the
+    Conv2D layer that precedes it, such that conv(x) == batch_norm(conv(x), training=False) afterward.
+    Both layers must be built and the convolution must use a bias.
+    """
+    gamma = batch_norm.gamma if batch_norm.scale else tf.ones_like(batch_norm.moving_variance)
+    beta = batch_norm.beta if batch_norm.center else tf.zeros_like(batch_norm.moving_mean)
+    scale = gamma * tf.math.rsqrt(batch_norm.moving_variance + batch_norm.epsilon)
+    conv.kernel.assign(conv.kernel * scale[None, None, None, :])
+    conv.bias.assign(beta + (conv.bias - batch_norm.moving_mean) * scale)
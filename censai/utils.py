@@ -3,6 +3,8 @@ import numpy as np
 import io
 import collections
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from matplotlib.colors import LogNorm, SymLogNorm, CenteredNorm
 import re
@@ -92,8 +94,9 @@ def plot_to_image(figure):
       returns it. The supplied figure is closed and inaccessible after this call.
       """
       buf = io.BytesIO()
-      plt.savefig(buf, format='png')
-      plt.close(figure)
+      figure.savefig(buf, format='png')
+      if figure.canvas.manager is not None:  # figures built without pyplot are not registered with it
+          plt.close(figure)
       buf.seek(0)
       # Convert PNG buffer to TF image
       image = tf.image.decode_png(buf.getvalue(), channels=4)
@@ -218,79 +221,82 @@ def raytracer_residual_plot(y_true, y_pred, lens_true, lens_pred):
 
 
 def rim_residual_plot(lens_true, source_true, kappa_true, lens_pred, source_pred, kappa_pred, chi_squared):
-    fig, axs = plt.subplots(3, 3, figsize=(12, 12))
+    # Built without pyplot, whose global state is not thread safe, so the plot can be rendered off the main thread
+    fig = Figure(figsize=(12, 12))
+    FigureCanvasAgg(fig)
+    axs = fig.subplots(3, 3)
 
     ax = axs[0, 0]
     im = ax.imshow(lens_true[..., 0], cmap="hot", origin="lower", vmin=0, vmax=1)
     divider = make_axes_locatable(ax)
     cax = divider.append_axes("right", size="5%", pad=0.05)
-    plt.colorbar(im, cax=cax)
+    fig.colorbar(im, cax=cax)
     ax.axis("off")
 
     ax = axs[1, 0]
     im = ax.imshow(source_true[..., 0], cmap="bone", origin="lower", vmin=0, vmax=1)
     divider = make_axes_locatable(ax)
     cax = divider.append_axes("right", size="5%", pad=0.05)
-    plt.colorbar(im, cax=cax)
+    fig.colorbar(im, cax=cax)
     ax.axis("off")
 
     ax = axs[2, 0]
     im = ax.imshow(kappa_true[..., 0], cmap="hot", norm=LogNorm(vmin=1e-1, vmax=100), origin="lower")
     divider = make_axes_locatable(ax)
     cax = divider.append_axes("right", size="5%", pad=0.05)
-    plt.colorbar(im, cax=cax)
+    fig.colorbar(im, cax=cax)
     ax.axis("off")
 
     ax = axs[0, 1]
     im = ax.imshow(lens_pred[..., 0], cmap="hot", origin="lower", vmin=0, vmax=1)
     divider = make_axes_locatable(ax)
     cax = divider.append_axes("right", size="5%", pad=0.05)
-    plt.colorbar(im, cax=cax)
+    fig.colorbar(im, cax=cax)
     ax.axis("off")
 
     ax = axs[1, 1]
     im = ax.imshow(source_pred[..., 0], cmap="bone", origin="lower", vmin=0, vmax=1)
     divider = make_axes_locatable(ax)
     cax = divider.append_axes("right", size="5%", pad=0.05)
-    plt.colorbar(im, cax=cax)
+    fig.colorbar(im, cax=cax)
     ax.axis("off")
 
     ax = axs[2, 1]
     im = ax.imshow(kappa_pred[..., 0], cmap="hot", norm=LogNorm(vmin=1e-1, vmax=100), origin="lower")
     divider = make_axes_locatable(ax)
     cax = divider.append_axes("right", size="5%", pad=0.05)
-    plt.colorbar(im, cax=cax)
+    fig.colorbar(im, cax=cax)
     ax.axis("off")
 
     ax = axs[0, 2]
     im = ax.imshow((lens_true - lens_pred)[..., 0], cmap="seismic", norm=CenteredNorm(), origin="lower")
     divider = make_axes_locatable(ax)
     cax = divider.append_axes("right", size="5%", pad=0.05)
-    plt.colorbar(im, cax=cax)
+    fig.colorbar(im, cax=cax)
     ax.axis("off")
 
     ax = axs[1, 2]
     im = ax.imshow((source_true - source_pred)[..., 0], cmap="seismic", norm=CenteredNorm(), origin="lower")
     divider = make_axes_locatable(ax)
     cax = divider.append_axes("right", size="5%", pad=0.05)
-    plt.colorbar(im, cax=cax)
+    fig.colorbar(im, cax=cax)
     ax.axis("off")
 
     ax = axs[2, 2]
     im = ax.imshow((kappa_true - kappa_pred)[..., 0], cmap="seismic", norm=SymLogNorm(linthresh=1e-1, base=10, vmax=100, vmin=-100), origin="lower")
     divider = make_axes_locatable(ax)
     cax = divider.append_axes("right", size="5%", pad=0.05)
-    plt.colorbar(im, cax=cax)
+    fig.colorbar(im, cax=cax)
     ax.axis("off")
 
     axs[0, 0].set_title("Ground Truth", size=15)
     axs[0, 1].set_title("Predictions", size=15)
     axs[0, 2].set_title("Residuals", size=15)
     fig.suptitle(fr"$\chi^2$ = {chi_squared: .3e}", size=20)
-    plt.subplots_adjust(wspace=.4, hspace=.2)
-    plt.figtext(0.1, 0.75, r"Lens", va="center", ha="center", size=15, rotation=90)
-    plt.figtext(0.1, 0.5, r"Source", va="center", ha="center", size=15, rotation=90)
-    plt.figtext(0.1, 0.22, r"$\kappa$", va="center", ha="center", size=15, rotation=90)
+    fig.subplots_adjust(wspace=.4, hspace=.2)
+    fig.text(0.1, 0.75, r"Lens", va="center", ha="center", size=15, rotation=90)
+    fig.text(0.1, 0.5, r"Source", va="center", ha="center", size=15, rotation=90)
+    fig.text(0.1, 0.22, r"$\kappa$", va="center", ha="center", size=15, rotation=90)
 
     return fig
 
@@ -1,33 +1,157 @@
 import tensorflow as tf
-from censai.data.lenses_tng import decode_all
-from censai.utils import _bytes_feature, _int64_feature, _float_feature
+from censai.data.lenses_tng import parse_example, decode_image
 import os, glob
-import numpy as np
 import math, time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-# total number of slurm workers detected
-# defaults to 1 if not running under SLURM
-N_WORKERS = int(os.getenv('SLURM_ARRAY_TASK_COUNT', 1))
 
-# this worker's array index. Assumes slurm array job is zero-indexed
-# defaults to zero if not running under SLURM
-THIS_WORKER = int(os.getenv('SLURM_ARRAY_TASK_ID', 0)) ## it starts from 1!!
+def slurm_workers():
+    """
+    Number of workers and one-indexed index of this worker. Every task of every array job is a separate worker:
+    tasks of a step are ranked by SLURM_PROCID within their array task. Defaults to a single worker when not running
+    under SLURM.
+    """
+    n_tasks = int(os.getenv("SLURM_NTASKS", 1))
+    task_id = int(os.getenv("SLURM_PROCID", 0))
+    n_arrays = int(os.getenv("SLURM_ARRAY_TASK_COUNT", 1))
+    array_id = int(os.getenv("SLURM_ARRAY_TASK_ID", 1))  # assumes slurm array job is one-indexed
+    return n_arrays * n_tasks, (array_id - 1) * n_tasks + task_id + 1
 
 
-def distributed_strategy(args):
-    files = [glob.glob(os.path.join(args.dataset, "*.tfrecords"))]
-    # Read concurrently from multiple records
-    files = tf.data.Dataset.from_tensor_slices(files).shuffle(len(files), reshuffle_each_iteration=False)
-    dataset = files.interleave(lambda x: tf.data.TFRecordDataset(x, compression_type=args.compression_type),
-                               block_length=1, num_parallel_calls=tf.data.AUTOTUNE)
-    total_items = int(np.sum(np.loadtxt(os.path.join(args.dataset, "shard_size.txt")), axis=0)[1])
+# kind of tf.train.Feature storing each field of a record. Image fields are kept as the raw bytes of the source record
+FEATURE_KINDS = {
+    "kappa": "bytes_list",
+    "source": "bytes_list",
+    "lens": "bytes_list",
+    "z source": "float_list",
+    "z lens": "float_list",
+    "image fov": "float_list",   # arc seconds
+    "kappa fov": "float_list",   # arc seconds
+    "source fov": "float_list",  # arc seconds
+    "src pixels": "int64_list",
+    "kappa pixels": "int64_list",
+    "pixels": "int64_list",
+    "noise rms": "float_list",
+    "psf": "bytes_list",
+    "psf pixels": "int64_list",
+    "fwhm": "float_list",
+    "dtype": "int64_list"    # datatype enum of the image fields
+}
+IMAGE_KEYS = ["kappa", "source", "lens", "psf"]
+LIST_MESSAGES = {"bytes_list": "tensorflow.BytesList", "float_list": "tensorflow.FloatList", "int64_list": "tensorflow.Int64List"}
+
+
+def _encode_proto(message_type, fields):
+    # encode_proto works on batches of messages, we encode a batch of one. Sub-messages are passed serialized
+    values = [tf.reshape(value, [1, -1]) for value in fields.values()]
+    sizes = tf.stack([tf.size(value) for value in values])[None]
+    return tf.io.encode_proto(sizes, values, list(fields.keys()), message_type)[0]
+
+
+def serialize(example):
+    """
+    Build a serialized tf.train.Example with graph ops, so tf.data can serialize records in parallel
+    without going through python protobuf objects.
+    """
+    entries = []
+    for key, kind in FEATURE_KINDS.items():
+        feature = _encode_proto("tensorflow.Feature", {kind: _encode_proto(LIST_MESSAGES[kind], {"value": example[key]})})
+        entries.append(_encode_proto("tensorflow.Features.FeatureEntry", {"key": tf.constant(key), "value": feature}))
+    features = _encode_proto("tensorflow.Features", {"feature": tf.stack(entries)})
+    return _encode_proto("tensorflow.Example", {"features": features})
+
+
+def quantize(example, dtype):
+    """
+    Re-encode the image fields in dtype (e.g. float16) to halve the size of the records. Readers cast them back to float32.
+    """
+    for key in IMAGE_KEYS:
+        image = tf.cast(decode_image(example[key], example["dtype"]), dtype)
+        # the content of a serialized TensorProto holds the raw bytes of the tensor
+        example[key] = tf.io.decode_proto(tf.io.serialize_tensor(image)[None], "tensorflow.TensorProto",
+                                          ["tensor_content"], [tf.string]).values[0][0, 0]
+    example["dtype"] = tf.constant(dtype.as_datatype_enum, tf.int64)
+    return example
+
+
+def write_shard(records, path, compression_type):
+    """
+    Stream serialized records to a TFRecord file. Reading, serialization and compression are pipelined by tf.data
+    instead of running one example at a time on the python thread.
+    """
+    records = records.prefetch(tf.data.AUTOTUNE)
+    writer = tf.data.experimental.TFRecordWriter(path, compression_type=compression_type)
+    writer.write(records)
+
+
+def read_total_items(dataset_dir):
+    # shard_size.txt has one line "worker_id items" per worker that produced the dataset
+    with open(os.path.join(dataset_dir, "shard_size.txt"), "r") as f:
+        return sum(int(line.split()[1]) for line in f if line.strip())
+
+
+def prepare(records, dtype):
+    # Records are already serialized examples, so they are copied verbatim unless they have to be re-encoded.
+    # Records are sharded before this step, so records belonging to other shards are never parsed. They are still read
+    # and decompressed, since the train/val split is taken after a shuffle over the whole dataset
+    if dtype == tf.float32:
+        return records
+    data = records.map(parse_example, num_parallel_calls=tf.data.AUTOTUNE)
+    data = data.map(lambda example: quantize(example, dtype), num_parallel_calls=tf.data.AUTOTUNE)
+    return data.map(serialize, num_parallel_calls=tf.data.AUTOTUNE)
+
+
+def pipeline_options():
+    options = tf.data.Options()
+    # let tf.data tune the parallelism of the maps and the size of the prefetch buffers
+    if hasattr(options, "autotune"):  # TF >= 2.7
+        options.autotune.enabled = True
+    else:
+        options.experimental_optimization.autotune = True
+        options.experimental_optimization.autotune_buffers = True
+    options.experimental_optimization.map_parallelization = True
+    # train/val membership is positional, the order of the records must not depend on scheduling
+    options.experimental_deterministic = True
+    return options
+
+
+def split_dataset(args):
+    files = sorted(glob.glob(os.path.join(args.dataset, "*.tfrecords")))
+    # Read concurrently from multiple records. Shuffling is seeded so that every worker sees the same ordering. The
+    # cycle length is fixed as well, its default depends on the number of cores of the node
+    file_dataset = tf.data.Dataset.from_tensor_slices(files).shuffle(len(files), reshuffle_each_iteration=False, seed=args.seed)
+    dataset = file_dataset.interleave(lambda x: tf.data.TFRecordDataset(x, compression_type=args.compression_type),
+                                      cycle_length=len(files), block_length=1, num_parallel_calls=tf.data.AUTOTUNE)
+    total_items = read_total_items(args.dataset)
     train_items = math.floor(args.train_split * total_items)
 
-    dataset = dataset.shuffle(args.buffer_size, reshuffle_each_iteration=False).map(decode_all)
+    # the shuffle buffer never needs to be larger than the dataset
+    dataset = dataset.shuffle(min(args.buffer_size, total_items), reshuffle_each_iteration=False, seed=args.seed)
+    dataset = dataset.with_options(pipeline_options())
     train_dataset = dataset.take(train_items)
     val_dataset = dataset.skip(train_items)
+    return train_dataset, val_dataset
+
+
+def write_split_shard(args, split, shard, num_shards, path):
+    """
+    Write a single shard of the train or val split. Every call rebuilds its own input pipeline, so shards
+    can be written concurrently from separate processes.
+    """
+    train_dataset, val_dataset = split_dataset(args)
+    dataset = train_dataset if split == "train" else val_dataset
+    output_compression_type = args.compression_type if args.output_compression_type is None else args.output_compression_type
+    records = prepare(dataset.shard(num_shards, shard), tf.as_dtype(args.dtype))
+    write_shard(records, path, output_compression_type)
+    return path
 
-    if THIS_WORKER > 1:
+
+def distributed_strategy(args, n_workers, this_worker):
+    total_items = read_total_items(args.dataset)
+    train_items = math.floor(args.train_split * total_items)
+
+    if this_worker > 1:
         time.sleep(3)
     train_dir = args.dataset + "_train"
     if not os.path.isdir(train_dir):
@@ -35,63 +159,31 @@ def distributed_strategy(args):
     val_dir = args.dataset + "_val"
     if not os.path.isdir(val_dir):
         os.mkdir(val_dir)
-    if THIS_WORKER <= 1:
+
+    if this_worker <= 1:
         with open(os.path.join(train_dir, "dataset_size.txt"), "w") as f:
             f.write(f"{train_items:d}")
         with open(os.path.join(val_dir, "dataset_size.txt"), "w") as f:
             f.write(f"{total_items-train_items:d}")
-    options = tf.io.TFRecordOptions(compression_type=args.compression_type)
     train_shards = train_items // args.examples_per_shard + 1 * (train_items % args.examples_per_shard > 0)
     val_shards = (total_items - train_items) // args.examples_per_shard + 1 * ((total_items - train_items) % args.examples_per_shard > 0)
 
-    for shard in range((THIS_WORKER - 1), train_shards, N_WORKERS):
-        data = train_dataset.skip(shard * args.examples_per_shard).take(args.examples_per_shard)
-        with tf.io.TFRecordWriter(os.path.join(train_dir, f"data_{shard:02d}.tfrecords"), options=options) as writer:
-            for example in data:
-                features = {
-                    "kappa": _bytes_feature(example["kappa"].numpy().tobytes()),
-                    "source": _bytes_feature(example["source"].numpy().tobytes()),
-                    "lens": _bytes_feature(example["lens"].numpy().tobytes()),
-                    "z source": _float_feature(example["z source"].numpy()),
-                    "z lens": _float_feature(example["z lens"].numpy()),
-                    "image fov": _float_feature(example["image fov"].numpy()),  # arc seconds
-                    "kappa fov": _float_feature(example["kappa fov"].numpy()),  # arc seconds
-                    "source fov": _float_feature(example["source fov"].numpy()),  # arc seconds
-                    "src pixels": _int64_feature(example["source"].shape[0]),
-                    "kappa pixels": _int64_feature(example["kappa"].shape[0]),
-                    "pixels": _int64_feature(example["lens"].shape[0]),
-                    "noise rms": _float_feature(example["noise rms"].numpy()),
-                    "psf": _bytes_feature(example["psf"].numpy().tobytes()),
-                    "psf pixels": _int64_feature(example["psf"].shape[0]),
-                    "fwhm": _float_feature(example["fwhm"].numpy())
-                }
-                serialized_output = tf.train.Example(features=tf.train.Features(feature=features))
-                record = serialized_output.SerializeToString()
-                writer.write(record)
-    for shard in range((THIS_WORKER - 1), val_shards, N_WORKERS):
-        data = val_dataset.skip(shard * args.examples_per_shard).take(args.examples_per_shard)
-        with tf.io.TFRecordWriter(os.path.join(val_dir, f"data_{shard:02d}.tfrecords"), options=options) as writer:
-            for example in data:
-                features = {
-                    "kappa": _bytes_feature(example["kappa"].numpy().tobytes()),
-                    "source": _bytes_feature(example["source"].numpy().tobytes()),
-                    "lens": _bytes_feature(example["lens"].numpy().tobytes()),
-                    "z source": _float_feature(example["z source"].numpy()),
-                    "z lens": _float_feature(example["z lens"].numpy()),
-                    "image fov": _float_feature(example["image fov"].numpy()),  # arc seconds
-                    "kappa fov": _float_feature(example["kappa fov"].numpy()),  # arc seconds
-                    "source fov": _float_feature(example["source fov"].numpy()),  # arc seconds
-                    "src pixels": _int64_feature(example["source"].shape[0]),
-                    "kappa pixels": _int64_feature(example["kappa"].shape[0]),
-                    "pixels": _int64_feature(example["lens"].shape[0]),
-                    "noise rms": _float_feature(example["noise rms"].numpy()),
-                    "psf": _bytes_feature(example["psf"].numpy().tobytes()),
-                    "psf pixels": _int64_feature(example["psf"].shape[0]),
-                    "fwhm": _float_feature(example["fwhm"].numpy())
-                }
-                serialized_output = tf.train.Example(features=tf.train.Features(feature=features))
-                record = serialized_output.SerializeToString()
-                writer.write(record)
+    jobs = []
+    for shard in range((this_worker - 1), train_shards, n_workers):
+        jobs.append(("train", shard, train_shards, os.path.join(train_dir, f"data_{shard:02d}.tfrecords")))
+    for shard in range((this_worker - 1), val_shards, n_workers):
+        jobs.append(("val", shard, val_shards, os.path.join(val_dir, f"data_{shard:02d}.tfrecords")))
+
+    if args.max_workers <= 1:
+        for job in jobs:
+            write_split_shard(args, *job)
+        return
+    # Shards are independent, write them from separate processes to use every core of the node for serialization and
+    # compression. Processes are spawned rather than forked since the TensorFlow runtime is not fork-safe
+    with ProcessPoolExecutor(max_workers=args.max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [executor.submit(write_split_shard, args, *job) for job in jobs]
+        for future in as_completed(futures):
+            future.result()
 
 
 if __name__ == '__main__':
@@ -99,10 +191,19 @@ if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument("--dataset", required=True, help="Path to dataset")
     parser.add_argument("--compression_type",   default="GZIP")
+    parser.add_argument("--output_compression_type", default=None,          help="Compression of the split dataset, one of 'GZIP', 'ZLIB' or '' (none). "
+                                                                                  "Defaults to --compression_type. Skipping compression is faster when disk space is not an issue.")
     parser.add_argument("--train_split", default=0.9, type=float, help="Fraction of the dataset in the training set")
     parser.add_argument("--buffer_size", default=10000, type=int)
     parser.add_argument("--examples_per_shard", default=10000,  type=int,       help="Number of example to store in a single shard")
+    parser.add_argument("--dtype",              default="float32",              help="Precision of the stored images, one of 'float32', 'float16' or 'bfloat16'. "
+                                                                                     "Half precision halves the size of the dataset, images are decoded in float32.")
+    parser.add_argument("--max_workers",        default=1,      type=int,       help="Number of processes writing shards concurrently. Use os.cpu_count() to saturate a node, "
+                                                                                     "each process holds its own shuffle buffer in memory.")
+    parser.add_argument("--seed",               default=42,     type=int,       help="Seed of the shuffling. Must be the same for every worker so they agree on the split.")
 
     args = parser.parse_args()
 
-    distributed_strategy(args)
+    # total number of slurm workers detected and this worker's index (it starts from 1!!)
+    n_workers, this_worker = slurm_workers()
+    distributed_strategy(args, n_workers, this_worker)
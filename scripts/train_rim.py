@@ -1,4 +1,26 @@
 import tensorflow as tf
+from argparse import ArgumentParser
+
+# GPU memory options have to be applied before anything initializes the devices, and importing censai already
+# creates tensors. They are parsed on their own here and the main parser inherits them.
+DEVICE_PARSER = ArgumentParser(add_help=False)
+DEVICE_PARSER.add_argument("--gpu_mem_growth",         action="store_true",            help="Allocate gpu memory as needed instead of reserving all of it at startup.")
+DEVICE_PARSER.add_argument("--gpu_mem_limit_mb",       default=None,   type=int,       help="Reserve this much memory (in MB) on each gpu. Cannot be combined with --gpu_mem_growth.")
+
+
+def configure_gpus(args):
+    if args.gpu_mem_growth and args.gpu_mem_limit_mb is not None:
+        raise ValueError("--gpu_mem_growth and --gpu_mem_limit_mb cannot be combined")
+    for gpu in tf.config.list_physical_devices('GPU'):
+        if args.gpu_mem_limit_mb is not None:
+            tf.config.set_logical_device_configuration(gpu, [tf.config.LogicalDeviceConfiguration(memory_limit=args.gpu_mem_limit_mb)])
+        elif args.gpu_mem_growth:
+            tf.config.experimental.set_memory_growth(gpu, True)
+
+
+if __name__ == "__main__":
+    configure_gpus(DEVICE_PARSER.parse_known_args()[0])
+
 import numpy as np
 import math
 from censai import PhysicalModel, RIM
@@ -6,14 +28,10 @@ from censai.models import Model, RayTracer
 from censai.utils import nullwriter, rim_residual_plot as residual_plot, plot_to_image
 from censai.data.lenses_tng import decode_train, decode_physical_model_info
 from censai.definitions import DTYPE
-import os, glob, time, json
+import os, glob, time, json, inspect
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
-gpus = tf.config.list_physical_devices('GPU')
-if len(gpus) == 1:
-    STRATEGY = tf.distribute.OneDeviceStrategy(device="/gpu:0")
-elif len(gpus) > 1:
-    STRATEGY = tf.distribute.MirroredStrategy()
 
 RIM_HPARAMS = [
     "adam",
@@ -44,6 +62,54 @@ UNET_MODEL_HPARAMS = [
     "gru_architecture",
     "filter_cap"
 ]
+# Each interleaved file is streamed with a large read buffer to cut down on small reads from network filesystems
+READ_BUFFER_SIZE = 8 * 1024**2
+
+
+def distribution_strategy(num_gpus):
+    gpus = tf.config.list_physical_devices('GPU')
+    if num_gpus >= 0:
+        gpus = gpus[:num_gpus]
+    if len(gpus) == 0:
+        return tf.distribute.get_strategy()
+    elif len(gpus) == 1:
+        return tf.distribute.OneDeviceStrategy(device="/gpu:0")
+    return tf.distribute.MirroredStrategy(devices=[f"/gpu:{i}" for i in range(len(gpus))])
+
+
+def check_batch_size(train_items, batch_size, grad_accum_steps, num_replicas):
+    if train_items < batch_size * grad_accum_steps:
+        raise ValueError(f"The training set ({train_items} items) is smaller than a single batch of "
+                         f"batch_size * grad_accum_steps = {batch_size * grad_accum_steps} items")
+    # each replica splits its share of the batch into grad_accum_steps micro-batches of the same size
+    if grad_accum_steps > 1 and batch_size % num_replicas != 0:
+        raise ValueError(f"batch_size ({batch_size}) must be a multiple of the number of replicas ({num_replicas}) "
+                         f"when grad_accum_steps > 1")
+
+
+def accumulate_gradients(gradient_step, variables, batch, grad_accum_steps):
+    """
+    Split the batch into grad_accum_steps micro-batches and average the gradients and scores returned by gradient_step.
+    The variables must already be built, the accumulators are zero-initialised from them.
+    """
+    micro_batches = [tf.reshape(x, [grad_accum_steps, -1, *x.shape[1:]]) for x in batch]
+    gradient = [tf.zeros_like(variable) for variable in variables]
+    scores = [tf.constant(0., DTYPE)] * 4  # cost, chi squared, source cost and kappa cost
+    for i in tf.range(grad_accum_steps):
+        micro_gradient, *micro_scores = gradient_step(*[x[i] for x in micro_batches])
+        gradient = [g + micro_g for g, micro_g in zip(gradient, micro_gradient)]
+        scores = [score + micro_score for score, micro_score in zip(scores, micro_scores)]
+    gradient = [g / grad_accum_steps for g in gradient]
+    return (gradient, *[score / grad_accum_steps for score in scores])
+
+
+def dataset_options(deterministic, optimizations):
+    options = tf.data.Options()
+    options.experimental_deterministic = deterministic
+    for optimization in optimizations:
+        setattr(options.experimental_optimization, optimization, True)
+    options.experimental_threading.private_threadpool_size = os.cpu_count()
+    return options
 
 
 def main(args):
@@ -61,10 +127,56 @@ def main(args):
             args_dict = vars(args)
             args_dict.update(json_override)
 
+    strategy = distribution_strategy(args.num_gpus)
+    # Pin the execution mode, so that a debugging session with eager functions does not leak into training runs
+    tf.config.run_functions_eagerly(args.compile_mode == "eager")
+    if args.xla_auto_clustering or args.compile_mode == "xla":
+        # Let XLA cluster the ops it supports in every graph, e.g. the fft and conv2d forward models. Ops without XLA kernels stay outside the clusters
+        tf.config.optimizer.set_jit(True)
+
+    if args.unroll_time_steps is None:
+        # the traced graph of the unrolled RIM grows with the number of steps
+        args.unroll_time_steps = args.steps <= 16
+    if args.compile_mode == "eager":  # the unrolled RIM takes its gradients with tf.gradients, which needs a graph
+        args.unroll_time_steps = False
+
+    if args.cache_policy is None:
+        args.cache_policy = "none" if args.cache_file is None else "file"
+    if args.cache_policy == "file" and args.cache_file is None:
+        print("Warning: --cache_policy file requires --cache_file, dataset will not be cached")
+        args.cache_policy = "none"
+
+    def cache(dataset, suffix=""):
+        if args.snapshot_dir is not None:  # decoded examples are written once to disk and read back by later epochs and runs
+            dataset = dataset.apply(tf.data.experimental.snapshot(args.snapshot_dir, compression=args.snapshot_compression))
+        if args.cache_policy == "memory":
+            return dataset.cache()
+        elif args.cache_policy == "file":
+            return dataset.cache(args.cache_file + suffix)
+        return dataset
+
+    optimizations = [optimization for optimization in args.tfdata_optimizations.split(",") if optimization]
+
     files = []
     for dataset in args.datasets:
         files.extend(glob.glob(os.path.join(dataset, "*.tfrecords")))
     np.random.shuffle(files)
+    # Read off global parameters from first example in dataset
+    physical_params = decode_physical_model_info(next(iter(tf.data.TFRecordDataset(files[0], compression_type=args.compression_type))))
+    physical_params = {key: value.numpy().item() for key, value in physical_params.items()}
+
+    def decode(record_bytes):
+        # Give the examples static shapes, so the distributed steps can be traced once from the dataset element spec
+        lens, source, kappa, noise_rms, psf = decode_train(record_bytes)
+        lens = tf.ensure_shape(lens, [physical_params["pixels"], physical_params["pixels"], 1])
+        source = tf.ensure_shape(source, [physical_params["src pixels"], physical_params["src pixels"], 1])
+        kappa = tf.ensure_shape(kappa, [physical_params["kappa pixels"], physical_params["kappa pixels"], 1])
+        psf = tf.ensure_shape(psf, [physical_params["psf pixels"], physical_params["psf pixels"], 1])
+        return lens, source, kappa, noise_rms, psf
+
+    train_items = args.total_items if args.val_datasets is not None else math.floor(args.train_split * args.total_items)
+    check_batch_size(train_items, args.batch_size, args.grad_accum_steps, strategy.num_replicas_in_sync)
+    cycle_length = args.cycle_length or min(len(files), os.cpu_count())
 
     if args.val_datasets is not None:
         """    
@@ -75,46 +187,48 @@ def main(args):
         Also, validation is not a split of the training data, but a saved dataset on disk. 
         """
         files = tf.data.Dataset.from_tensor_slices(files).shuffle(len(files), reshuffle_each_iteration=True)
-        dataset = files.interleave(lambda x: tf.data.TFRecordDataset(x, compression_type=args.compression_type),
-                                   block_length=args.block_length, num_parallel_calls=tf.data.AUTOTUNE)
-        # Read off global parameters from first example in dataset
-        for physical_params in dataset.map(decode_physical_model_info):
-            break
-        # preprocessing
-        dataset = dataset.map(decode_train)
-        if args.cache_file is not None:
-            dataset = dataset.cache(args.cache_file)
-        train_dataset = dataset.shuffle(buffer_size=args.buffer_size, reshuffle_each_iteration=True).take(args.total_items).batch(args.batch_size).prefetch(tf.data.experimental.AUTOTUNE)
+        dataset = files.interleave(lambda x: tf.data.TFRecordDataset(x, compression_type=args.compression_type, buffer_size=READ_BUFFER_SIZE), cycle_length=cycle_length,
+                                   block_length=args.block_length, num_parallel_calls=args.num_parallel_calls, deterministic=args.deterministic)
+        # preprocessing. Order does not matter since examples are shuffled afterward
+        dataset = dataset.map(decode, num_parallel_calls=args.num_parallel_calls, deterministic=args.deterministic)
+        dataset = cache(dataset)
+        train_dataset = dataset.shuffle(buffer_size=args.buffer_size, reshuffle_each_iteration=True).take(args.total_items).batch(args.batch_size * args.grad_accum_steps, drop_remainder=True).prefetch(args.prefetch_buffer)
 
         val_files = []
         for dataset in args.val_datasets:
             val_files.extend(glob.glob(os.path.join(dataset, "*.tfrecords")))
+        val_cycle_length = args.cycle_length or min(len(val_files), os.cpu_count())
         val_files = tf.data.Dataset.from_tensor_slices(val_files).shuffle(len(files), reshuffle_each_iteration=True)
-        val_dataset = val_files.interleave(lambda x: tf.data.TFRecordDataset(x, compression_type=args.compression_type), block_length=args.block_length, num_parallel_calls=tf.data.AUTOTUNE)
-        val_dataset = val_dataset.map(decode_train).shuffle(buffer_size=args.buffer_size, reshuffle_each_iteration=True).\
+        val_dataset = val_files.interleave(lambda x: tf.data.TFRecordDataset(x, compression_type=args.compression_type, buffer_size=READ_BUFFER_SIZE), cycle_length=val_cycle_length,
+                                           block_length=args.block_length, num_parallel_calls=args.num_parallel_calls, deterministic=args.deterministic)
+        val_dataset = val_dataset.map(decode, num_parallel_calls=args.num_parallel_calls, deterministic=args.deterministic)
+        val_dataset = cache(val_dataset, "_val")
+        val_dataset = val_dataset.shuffle(buffer_size=args.buffer_size, reshuffle_each_iteration=True).\
             take(math.ceil((1 - args.train_split) * args.total_items)).\
-            batch(args.batch_size).prefetch(tf.data.experimental.AUTOTUNE)
+            batch(args.batch_size).prefetch(args.prefetch_buffer)
+        # Examples are reshuffled at each epoch anyway, so let fast files overtake slow ones unless asked otherwise
+        train_dataset = train_dataset.with_options(dataset_options(args.deterministic, optimizations))
+        val_dataset = val_dataset.with_options(dataset_options(args.deterministic, optimizations))
     else:
         """
         Here, we split the dataset, so we assume total_items is the true dataset size. Any extra items will be discarded. 
         This is to make sure validation set is never seen by the model, so shuffling occurs after the split.
         """
         files = tf.data.Dataset.from_tensor_slices(files)
-        dataset = files.interleave(lambda x: tf.data.TFRecordDataset(x, compression_type=args.compression_type),
-                                   block_length=args.block_length, num_parallel_calls=tf.data.AUTOTUNE)
-        # Read off global parameters from first example in dataset
-        for physical_params in dataset.map(decode_physical_model_info):
-            break
-        # preprocessing
-        dataset = dataset.map(decode_train)
-        if args.cache_file is not None:
-            dataset = dataset.cache(args.cache_file)
-        train_dataset = dataset.take(math.floor(args.train_split * args.total_items)).shuffle(buffer_size=args.buffer_size, reshuffle_each_iteration=True).batch(args.batch_size).prefetch(tf.data.experimental.AUTOTUNE)
-        val_dataset = dataset.skip(math.floor(args.train_split * args.total_items)).take(math.ceil((1 - args.train_split) * args.total_items)).batch(args.batch_size).prefetch(tf.data.experimental.AUTOTUNE)
-
-    train_dataset = STRATEGY.experimental_distribute_dataset(train_dataset)
-    val_dataset = STRATEGY.experimental_distribute_dataset(val_dataset)
-    with STRATEGY.scope():  # Replicate ops accross gpus
+        dataset = files.interleave(lambda x: tf.data.TFRecordDataset(x, compression_type=args.compression_type, buffer_size=READ_BUFFER_SIZE),
+                                   cycle_length=cycle_length, block_length=args.block_length, num_parallel_calls=args.num_parallel_calls)
+        # preprocessing. The map stays deterministic because the train/val split is positional
+        dataset = dataset.map(decode, num_parallel_calls=args.num_parallel_calls)
+        # Each split is cached on its own, after take, so its cache is completed at the end of the first epoch
+        train_dataset = cache(dataset.take(math.floor(args.train_split * args.total_items))).shuffle(buffer_size=args.buffer_size, reshuffle_each_iteration=True).batch(args.batch_size * args.grad_accum_steps, drop_remainder=True).prefetch(args.prefetch_buffer)
+        val_dataset = cache(dataset.skip(math.floor(args.train_split * args.total_items)).take(math.ceil((1 - args.train_split) * args.total_items)), "_val").batch(args.batch_size).prefetch(args.prefetch_buffer)
+        # The split is positional, so records must be read in the same order in every epoch
+        train_dataset = train_dataset.with_options(dataset_options(True, optimizations))
+        val_dataset = val_dataset.with_options(dataset_options(True, optimizations))
+
+    train_dataset = strategy.experimental_distribute_dataset(train_dataset)
+    val_dataset = strategy.experimental_distribute_dataset(val_dataset)
+    with strategy.scope():  # Replicate ops accross gpus
         if args.raytracer is not None:
             with open(os.path.join(args.raytracer, "ray_tracer_hparams.json"), "r") as f:
                 raytracer_hparams = json.load(f)
@@ -126,16 +240,19 @@ def main(args):
         else:
             raytracer = None
         phys = PhysicalModel(
-            pixels=physical_params["pixels"].numpy(),
-            kappa_pixels=physical_params["kappa pixels"].numpy(),
-            src_pixels=physical_params["src pixels"].numpy(),
-            image_fov=physical_params["image fov"].numpy(),
-            kappa_fov=physical_params["kappa fov"].numpy(),
-            src_fov=physical_params["source fov"].numpy(),
+            pixels=physical_params["pixels"],
+            kappa_pixels=physical_params["kappa pixels"],
+            src_pixels=physical_params["src pixels"],
+            image_fov=physical_params["image fov"],
+            kappa_fov=physical_params["kappa fov"],
+            src_fov=physical_params["source fov"],
             method=args.forward_method,
             raytracer=raytracer,
         )
 
+        if args.mixed_precision != "none":
+            # Only the unet computes in half precision. The physical model and the cost stay in full precision
+            tf.keras.mixed_precision.set_global_policy(args.mixed_precision)
         unet = Model(
             filters=args.filters,
             filter_scaling=args.filter_scaling,
@@ -158,6 +275,7 @@ def main(args):
             dropout_rate=args.dropout_rate,
             filter_cap=args.filter_cap
         )
+        tf.keras.mixed_precision.set_global_policy(DTYPE.name)
         rim = RIM(
             physical_model=phys,
             unet=unet,
@@ -168,6 +286,8 @@ def main(args):
             kappa_normalize=args.kappa_normalize,
             flux_lagrange_multiplier=args.flux_lagrange_multiplier
         )
+        if args.grad_accum_steps > 1:  # the gradient accumulators are created from the unet variables, before the train step is traced
+            rim.unet(tf.zeros([1, rim.pixels, rim.pixels, 5], dtype=DTYPE), rim.unet.init_hidden_states(rim.pixels, 1))
         learning_rate_schedule = tf.keras.optimizers.schedules.ExponentialDecay(
             initial_learning_rate=args.initial_learning_rate,
             decay_rate=args.decay_rate,
@@ -180,38 +300,42 @@ def main(args):
                 'config': {"learning_rate": learning_rate_schedule}
             }
         )
+        if args.mixed_precision == "mixed_float16":  # float16 gradients need loss scaling to avoid underflow
+            optim = tf.keras.mixed_precision.LossScaleOptimizer(optim)
         # weights for time steps in the loss function
         if args.time_weights == "uniform":
-            wt = tf.ones(shape=(args.steps), dtype=DTYPE) / args.steps
+            wt = np.ones(args.steps) / args.steps
         elif args.time_weights == "linear":
-            wt = 2 * (tf.range(args.steps, dtype=DTYPE) + 1) / args.steps / (args.steps + 1)
+            wt = 2 * (np.arange(args.steps) + 1) / args.steps / (args.steps + 1)
         elif args.time_weights == "quadratic":
-            wt = 6 * (tf.range(args.steps, dtype=DTYPE) + 1)**2 / args.steps / (args.steps + 1) / (2 * args.steps + 1)
+            wt = 6 * (np.arange(args.steps) + 1)**2 / args.steps / (args.steps + 1) / (2 * args.steps + 1)
         else:
             raise ValueError("time_weights must be in ['uniform', 'linear', 'quadratic']")
-        wt = wt[..., tf.newaxis]  # [steps, batch]
+        wt = tf.constant(wt.reshape([args.steps, 1, 1, 1, 1]), dtype=DTYPE)  # broadcast against [steps, batch, pixels, pixels, channels]
 
+        # Pixel weights of the residuals are plain functions, traced inline in the cost. The uniform normalisation
+        # only depends on the static shape of the images, so it is a python constant instead of a graph reduction
         if args.kappa_residual_weights == "uniform":
-            wk = tf.keras.layers.Lambda(lambda k: tf.ones_like(k, dtype=DTYPE) / tf.cast(tf.math.reduce_prod(k.shape[1:]), DTYPE))
+            wk = lambda k: 1. / float(np.prod(k.shape[1:]))
         elif args.kappa_residual_weights == "linear":
-            wk = tf.keras.layers.Lambda(lambda k: k / tf.reduce_sum(k, axis=(1, 2, 3), keepdims=True))
+            wk = lambda k: k / tf.reduce_sum(k, axis=(1, 2, 3), keepdims=True)
         elif args.kappa_residual_weights == "sqrt":
-            wk = tf.keras.layers.Lambda(lambda k: tf.sqrt(k) / tf.reduce_sum(tf.sqrt(k), axis=(1, 2, 3), keepdims=True))
+            wk = lambda k: tf.sqrt(k) / tf.reduce_sum(tf.sqrt(k), axis=(1, 2, 3), keepdims=True)
         elif args.kappa_residual_weights == "quadratic":
-            wk = tf.keras.layers.Lambda(lambda k: tf.square(k) / tf.reduce_sum(tf.square(k), axis=(1, 2, 3), keepdims=True))
+            wk = lambda k: tf.square(k) / tf.reduce_sum(tf.square(k), axis=(1, 2, 3), keepdims=True)
         else:
             raise ValueError("kappa_residual_weights must be in ['uniform', 'linear', 'quadratic', 'sqrt']")
 
         if args.source_residual_weights == "uniform":
-            ws = tf.keras.layers.Lambda(lambda s: tf.ones_like(s, dtype=DTYPE) / tf.cast(tf.math.reduce_prod(s.shape[1:]), DTYPE))
+            ws = lambda s: 1. / float(np.prod(s.shape[1:]))
         elif args.source_residual_weights == "linear":
-            ws = tf.keras.layers.Lambda(lambda s: s / tf.reduce_sum(s, axis=(1, 2, 3), keepdims=True))
+            ws = lambda s: s / tf.reduce_sum(s, axis=(1, 2, 3), keepdims=True)
         elif args.source_residual_weights == "quadratic":
-            ws = tf.keras.layers.Lambda(lambda s: tf.square(s) / tf.reduce_sum(tf.square(s), axis=(1, 2, 3), keepdims=True))
+            ws = lambda s: tf.square(s) / tf.reduce_sum(tf.square(s), axis=(1, 2, 3), keepdims=True)
         elif args.source_residual_weights == "sqrt":
-            ws = tf.keras.layers.Lambda(lambda s: tf.sqrt(s) / tf.reduce_sum(tf.sqrt(s), axis=(1, 2, 3), keepdims=True))
+            ws = lambda s: tf.sqrt(s) / tf.reduce_sum(tf.sqrt(s), axis=(1, 2, 3), keepdims=True)
         else:
-            raise ValueError("kappa_residual_weights must be in ['uniform', 'linear', 'quadratic', 'sqrt']")
+            raise ValueError("source_residual_weights must be in ['uniform', 'linear', 'quadratic', 'sqrt']")
 
     # ==== Take care of where to write logs and stuff =================================================================
     if args.model_id.lower() != "none":
@@ -227,7 +351,8 @@ def main(args):
     else:
         logname = args.logname_prefixe + "_" + datetime.now().strftime("%y%m%d%H%M%S")
         model_id = logname
-    if args.logdir.lower() != "none":
+    log = args.logdir is not None and args.logdir.lower() != "none"
+    if log:
         logdir = os.path.join(args.logdir, logname)
         if not os.path.isdir(logdir):
             os.mkdir(logdir)
@@ -251,6 +376,8 @@ def main(args):
         ckpt = tf.train.Checkpoint(step=tf.Variable(1), optimizer=optim, net=rim.unet)
         checkpoint_manager = tf.train.CheckpointManager(ckpt, old_checkpoints_dir, max_to_keep=args.max_to_keep)
         save_checkpoint = True
+        # Async checkpoints (TF >= 2.9, checked when parsing arguments) copy the variables and write them to disk on a background thread
+        checkpoint_options = tf.train.CheckpointOptions(experimental_enable_async_checkpoint=True) if args.async_checkpoint else None
         # ======= Load model if model_id is provided ===============================================================
         if args.model_id.lower() != "none":
             checkpoint_manager.checkpoint.restore(checkpoint_manager.latest_checkpoint)
@@ -262,6 +389,8 @@ def main(args):
                         'config': {"learning_rate": learning_rate_schedule}
                     }
                 )
+                if args.mixed_precision == "mixed_float16":
+                    optim = tf.keras.mixed_precision.LossScaleOptimizer(optim)
                 ckpt = tf.train.Checkpoint(step=tf.Variable(1), optimizer=optim, net=rim.unet)
             checkpoint_manager = tf.train.CheckpointManager(ckpt, checkpoints_dir, max_to_keep=args.max_to_keep)
 
@@ -269,76 +398,120 @@ def main(args):
         save_checkpoint = False
     # =================================================================================================================
 
-    def train_step(X, source, kappa, noise_rms, psf):
+    # Epoch metrics are accumulated inside the compiled steps, without a round trip to python at each batch
+    epoch_loss = tf.metrics.Mean()
+    time_per_step = tf.metrics.Mean()
+    val_loss = tf.metrics.Mean()
+    epoch_chi_squared = tf.metrics.Mean()
+    epoch_source_loss = tf.metrics.Mean()
+    epoch_kappa_loss = tf.metrics.Mean()
+    val_chi_squared = tf.metrics.Mean()
+    val_source_loss = tf.metrics.Mean()
+    val_kappa_loss = tf.metrics.Mean()
+
+    # The physical model relies on the addons resampler which has no XLA kernel, so only the cost is compiled
+    @tf.function(experimental_compile=args.jit_compile)
+    def residual_costs(source_series, kappa_series, source, kappa):
+        # targets in model prediction space, broadcasted against the time axis of the series
+        source_target = rim.source_inverse_link(source)
+        kappa_target = rim.kappa_inverse_link(kappa)
+        # weighted mean over image residuals (in model prediction space) and time steps, in a single reduction
+        source_cost = tf.reduce_sum(wt * ws(source) * tf.square(source_series - source_target), axis=(0, 2, 3, 4))
+        kappa_cost = tf.reduce_sum(wt * wk(kappa) * tf.square(kappa_series - kappa_target), axis=(0, 2, 3, 4))
+        # final cost is mean over global batch size (batches are split across replicas by the distributed dataset)
+        cost = tf.nn.compute_average_loss(kappa_cost + source_cost, global_batch_size=args.batch_size)
+        # "converged" score of the last time step
+        last_source_cost = tf.reduce_sum(ws(source) * tf.square(source_series[-1] - source_target), axis=(1, 2, 3))
+        last_kappa_cost = tf.reduce_sum(wk(kappa) * tf.square(kappa_series[-1] - kappa_target), axis=(1, 2, 3))
+        return cost, last_source_cost, last_kappa_cost
+
+    def gradient_step(X, source, kappa, noise_rms, psf):
         with tf.GradientTape() as tape:
             tape.watch(rim.unet.trainable_variables)
             if args.unroll_time_steps:
                 source_series, kappa_series, chi_squared = rim.call_function(X, noise_rms, psf)
             else:
                 source_series, kappa_series, chi_squared = rim.call(X, noise_rms, psf, outer_tape=tape)
-            # mean over image residuals (in model prediction space)
-            source_cost1 = tf.reduce_sum(ws(source) * tf.square(source_series - rim.source_inverse_link(source)), axis=(2, 3, 4))
-            kappa_cost1 = tf.reduce_sum(wk(kappa) * tf.square(kappa_series - rim.kappa_inverse_link(kappa)), axis=(2, 3, 4))
-            # weighted mean over time steps
-            source_cost = tf.reduce_sum(wt * source_cost1, axis=0)
-            kappa_cost = tf.reduce_sum(wt * kappa_cost1, axis=0)
-            # final cost is mean over global batch size
-            cost = tf.reduce_sum(kappa_cost + source_cost) / args.batch_size
-        gradient = tape.gradient(cost, rim.unet.trainable_variables)
-        gradient = [tf.clip_by_norm(grad, 5.) for grad in gradient]
-        optim.apply_gradients(zip(gradient, rim.unet.trainable_variables))
+            cost, last_source_cost, last_kappa_cost = residual_costs(source_series, kappa_series, source, kappa)
+            scaled_cost = optim.get_scaled_loss(cost) if args.mixed_precision == "mixed_float16" else cost
+        gradient = tape.gradient(scaled_cost, rim.unet.trainable_variables)
+        if args.mixed_precision == "mixed_float16":
+            gradient = optim.get_unscaled_gradients(gradient)
         # Update metrics with "converged" score
-        chi_squared = tf.reduce_sum(chi_squared[-1]) / args.batch_size
-        source_cost = tf.reduce_sum(source_cost1[-1]) / args.batch_size
-        kappa_cost = tf.reduce_sum(kappa_cost1[-1]) / args.batch_size
+        chi_squared = tf.nn.compute_average_loss(chi_squared[-1], global_batch_size=args.batch_size)
+        source_cost = tf.nn.compute_average_loss(last_source_cost, global_batch_size=args.batch_size)
+        kappa_cost = tf.nn.compute_average_loss(last_kappa_cost, global_batch_size=args.batch_size)
+        return gradient, cost, chi_squared, source_cost, kappa_cost
+
+    def train_step(X, source, kappa, noise_rms, psf):
+        if args.grad_accum_steps == 1:
+            gradient, cost, chi_squared, source_cost, kappa_cost = gradient_step(X, source, kappa, noise_rms, psf)
+        else:
+            # The batch holds grad_accum_steps micro-batches, their gradients are averaged before a single update
+            gradient, cost, chi_squared, source_cost, kappa_cost = accumulate_gradients(gradient_step, rim.unet.trainable_variables, (X, source, kappa, noise_rms, psf), args.grad_accum_steps)
+        gradient, _ = tf.clip_by_global_norm(gradient, clip_norm=args.clipnorm)
+        optim.apply_gradients(zip(gradient, rim.unet.trainable_variables))
         return cost, chi_squared, source_cost, kappa_cost
 
-    @tf.function
+    # Train batches are full and examples have static shapes, so the train step is traced only once
+    @tf.function(input_signature=train_dataset.element_spec)
     def distributed_train_step(X, source, kappa, noise_rms, psf):
-        per_replica_losses, per_replica_chi_squared, per_replica_source_cost, per_replica_kappa_cost = STRATEGY.run(train_step, args=(X, source, kappa, noise_rms, psf))
+        per_replica_losses, per_replica_chi_squared, per_replica_source_cost, per_replica_kappa_cost = strategy.run(train_step, args=(X, source, kappa, noise_rms, psf))
         # Replica losses are aggregated by summing them
-        global_loss = STRATEGY.reduce(tf.distribute.ReduceOp.SUM, per_replica_losses, axis=None)
-        global_chi_squared = STRATEGY.reduce(tf.distribute.ReduceOp.SUM, per_replica_chi_squared, axis=None)
-        global_source_cost = STRATEGY.reduce(tf.distribute.ReduceOp.SUM, per_replica_source_cost, axis=None)
-        global_kappa_cost = STRATEGY.reduce(tf.distribute.ReduceOp.SUM, per_replica_kappa_cost, axis=None)
-        return global_loss, global_chi_squared, global_source_cost, global_kappa_cost
+        global_loss = strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica_losses, axis=None)
+        global_chi_squared = strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica_chi_squared, axis=None)
+        global_source_cost = strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica_source_cost, axis=None)
+        global_kappa_cost = strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica_kappa_cost, axis=None)
+        epoch_loss.update_state(global_loss)
+        epoch_chi_squared.update_state(global_chi_squared)
+        epoch_source_loss.update_state(global_source_cost)
+        epoch_kappa_loss.update_state(global_kappa_cost)
 
     def test_step(X, source, kappa, noise_rms, psf):
         source_series, kappa_series, chi_squared = rim.call(X, noise_rms, psf)
-        # mean over image residuals (in model prediction space)
-        source_cost1 = tf.reduce_sum(ws(source) * tf.square(source_series - rim.source_inverse_link(source)), axis=(2, 3, 4))
-        kappa_cost1 = tf.reduce_sum(wk(kappa) * tf.square(kappa_series - rim.kappa_inverse_link(kappa)), axis=(2, 3, 4))
-        # weighted mean over time steps
-        source_cost = tf.reduce_sum(wt * source_cost1, axis=0)
-        kappa_cost = tf.reduce_sum(wt * kappa_cost1, axis=0)
-        # final cost is mean over global batch size
-        cost = tf.reduce_sum(kappa_cost + source_cost) / args.batch_size
+        cost, last_source_cost, last_kappa_cost = residual_costs(source_series, kappa_series, source, kappa)
         # Update metrics with "converged" score
-        chi_squared = tf.reduce_sum(chi_squared[-1]) / args.batch_size
-        source_cost = tf.reduce_sum(source_cost1[-1]) / args.batch_size
-        kappa_cost = tf.reduce_sum(kappa_cost1[-1]) / args.batch_size
+        chi_squared = tf.nn.compute_average_loss(chi_squared[-1], global_batch_size=args.batch_size)
+        source_cost = tf.nn.compute_average_loss(last_source_cost, global_batch_size=args.batch_size)
+        kappa_cost = tf.nn.compute_average_loss(last_kappa_cost, global_batch_size=args.batch_size)
         return cost, chi_squared, source_cost, kappa_cost
 
+    # The last partial validation batch is traced once, then reused in every epoch
     @tf.function
     def distributed_test_step(X, source, kappa, noise_rms, psf):
-        per_replica_losses, per_replica_chi_squared, per_replica_source_cost, per_replica_kappa_cost = STRATEGY.run(test_step, args=(X, source, kappa, noise_rms, psf))
+        per_replica_losses, per_replica_chi_squared, per_replica_source_cost, per_replica_kappa_cost = strategy.run(test_step, args=(X, source, kappa, noise_rms, psf))
         # Replica losses are aggregated by summing them
-        global_loss = STRATEGY.reduce(tf.distribute.ReduceOp.SUM, per_replica_losses, axis=None)
-        global_chi_squared = STRATEGY.reduce(tf.distribute.ReduceOp.SUM, per_replica_chi_squared, axis=None)
-        global_source_cost = STRATEGY.reduce(tf.distribute.ReduceOp.SUM, per_replica_source_cost, axis=None)
-        global_kappa_cost = STRATEGY.reduce(tf.distribute.ReduceOp.SUM, per_replica_kappa_cost, axis=None)
-        return global_loss, global_chi_squared, global_source_cost, global_kappa_cost
+        global_loss = strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica_losses, axis=None)
+        global_chi_squared = strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica_chi_squared, axis=None)
+        global_source_cost = strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica_source_cost, axis=None)
+        global_kappa_cost = strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica_kappa_cost, axis=None)
+        val_loss.update_state(global_loss)
+        val_chi_squared.update_state(global_chi_squared)
+        val_source_loss.update_state(global_source_cost)
+        val_kappa_loss.update_state(global_kappa_cost)
+
+    # Residual plots are rendered with matplotlib on a background thread, so they do not stall the next epoch
+    plot_executor = ThreadPoolExecutor(max_workers=1)
+
+    def log_residuals(name, step, *images):
+        images = [image.numpy() for image in images]
+        with writer.as_default():  # the default writer is local to a thread
+            for res_idx in range(images[0].shape[0]):
+                try:
+                    tf.summary.image(f"{name} {res_idx}", plot_to_image(residual_plot(*[image[res_idx] for image in images])), step=step)
+                except ValueError:
+                    continue
+
+    plot_future = None
+
+    def submit_residuals(name, step, *images):
+        # At most one plot is pending, so errors of the plotting thread are raised here and the queue stays bounded
+        nonlocal plot_future
+        if plot_future is not None:
+            plot_future.result()
+        plot_future = plot_executor.submit(log_residuals, name, step, *images)
 
     # ====== Training loop ============================================================================================
-    epoch_loss = tf.metrics.Mean()
-    time_per_step = tf.metrics.Mean()
-    val_loss = tf.metrics.Mean()
-    epoch_chi_squared = tf.metrics.Mean()
-    epoch_source_loss = tf.metrics.Mean()
-    epoch_kappa_loss = tf.metrics.Mean()
-    val_chi_squared = tf.metrics.Mean()
-    val_source_loss = tf.metrics.Mean()
-    val_kappa_loss = tf.metrics.Mean()
     history = {  # recorded at the end of an epoch only
         "train_cost": [],
         "train_chi_squared": [],
@@ -360,46 +533,31 @@ def main(args):
     estimated_time_for_epoch = 0
     out_of_time = False
     lastest_checkpoint = 1
-    for epoch in range(args.epochs):
-        if (time.time() - global_start) > args.max_time*3600 - estimated_time_for_epoch:
-            break
-        epoch_start = time.time()
-        epoch_loss.reset_states()
-        epoch_chi_squared.reset_states()
-        epoch_source_loss.reset_states()
-        epoch_kappa_loss.reset_states()
-        time_per_step.reset_states()
-        with writer.as_default():
+    try:
+        for epoch in range(args.epochs):
+            if (time.time() - global_start) > args.max_time*3600 - estimated_time_for_epoch:
+                break
+            epoch_start = time.time()
+            epoch_loss.reset_states()
+            epoch_chi_squared.reset_states()
+            epoch_source_loss.reset_states()
+            epoch_kappa_loss.reset_states()
+            time_per_step.reset_states()
             for batch, (X, source, kappa, noise_rms, psf) in enumerate(train_dataset):
                 start = time.time()
-                cost, chi_squared, source_cost, kappa_cost = distributed_train_step(X, source, kappa, noise_rms, psf)
-        # ========== Summary and logs ==================================================================================
+                distributed_train_step(X, source, kappa, noise_rms, psf)
+            # ========== Summary and logs ==================================================================================
                 _time = time.time() - start
-                time_per_step.update_state([_time])
-                epoch_loss.update_state([cost])
-                epoch_chi_squared.update_state([chi_squared])
-                epoch_source_loss.update_state([source_cost])
-                epoch_kappa_loss.update_state([kappa_cost])
+                time_per_step.update_state(_time)
                 step += 1
             # last batch we make a summary of residuals
-            if args.n_residuals > 0:
-                source_pred, kappa_pred, chi_squared = rim.predict(X, noise_rms, psf)
-                lens_pred = phys.forward(source_pred[-1], kappa_pred[-1], psf)
-            for res_idx in range(min(args.n_residuals, args.batch_size)):
-                try:
-                    tf.summary.image(f"Residuals {res_idx}",
-                                     plot_to_image(
-                                         residual_plot(
-                                             X[res_idx],
-                                             source[res_idx],
-                                             kappa[res_idx],
-                                             lens_pred[res_idx],
-                                             source_pred[-1][res_idx],
-                                             kappa_pred[-1][res_idx],
-                                             chi_squared[-1][res_idx]
-                                         )), step=step)
-                except ValueError:
-                    continue
+            plot_residuals = log and args.n_residuals > 0 and args.residuals_every > 0 and epoch % args.residuals_every == 0
+            if plot_residuals:
+                # a single micro-batch, the accumulated batch might not fit in memory
+                source_pred, kappa_pred, chi_squared = rim.predict(X[:args.batch_size], noise_rms[:args.batch_size], psf[:args.batch_size])
+                lens_pred = phys.forward(source_pred[-1], kappa_pred[-1], psf[:args.batch_size])
+                n = min(args.n_residuals, args.batch_size)
+                submit_residuals("Residuals", step, X[:n], source[:n], kappa[:n], lens_pred[:n], source_pred[-1][:n], kappa_pred[-1][:n], chi_squared[-1][:n])
 
             # ========== Validation set ===================
             val_loss.reset_states()
@@ -407,30 +565,13 @@ def main(args):
             val_source_loss.reset_states()
             val_kappa_loss.reset_states()
             for X, source, kappa, noise_rms, psf in val_dataset:
-                cost, chi_squared, source_cost, kappa_cost = distributed_test_step(X, source, kappa, noise_rms, psf)
-                val_loss.update_state([cost])
-                val_chi_squared.update_state([chi_squared])
-                val_source_loss.update_state([source_cost])
-                val_kappa_loss.update_state([kappa_cost])
+                distributed_test_step(X, source, kappa, noise_rms, psf)
 
-            if args.n_residuals > 0 and math.ceil((1 - args.train_split) * args.total_items) > 0:  # validation set not empty set not empty
+            if plot_residuals and math.ceil((1 - args.train_split) * args.total_items) > 0:  # validation set not empty set not empty
                 source_pred, kappa_pred, chi_squared = rim.predict(X, noise_rms, psf)
                 lens_pred = phys.forward(source_pred[-1], kappa_pred[-1], psf)
-            for res_idx in range(min(args.n_residuals, args.batch_size, math.ceil((1 - args.train_split) * args.total_items))):
-                try:
-                    tf.summary.image(f"Val Residuals {res_idx}",
-                                     plot_to_image(
-                                         residual_plot(
-                                             X[res_idx],  # rescale intensity like it is done in the likelihood
-                                             source[res_idx],
-                                             kappa[res_idx],
-                                             lens_pred[res_idx],
-                                             source_pred[-1][res_idx],
-                                             kappa_pred[-1][res_idx],
-                                             chi_squared[-1][res_idx]
-                                         )), step=step)
-                except ValueError:
-                    continue
+                n = min(args.n_residuals, args.batch_size, math.ceil((1 - args.train_split) * args.total_items))
+                submit_residuals("Val Residuals", step, X[:n], source[:n], kappa[:n], lens_pred[:n], source_pred[-1][:n], kappa_pred[-1][:n], chi_squared[-1][:n])
             val_cost = val_loss.result().numpy()
             train_cost = epoch_loss.result().numpy()
             val_chi_sq = val_chi_squared.result().numpy()
@@ -439,68 +580,76 @@ def main(args):
             train_kappa_cost = epoch_kappa_loss.result().numpy()
             val_source_cost = val_source_loss.result().numpy()
             train_source_cost = epoch_source_loss.result().numpy()
-            tf.summary.scalar("Time per step", time_per_step.result(), step=step)
-            tf.summary.scalar("Chi Squared", train_chi_sq, step=step)
-            tf.summary.scalar("Kappa cost", train_kappa_cost, step=step)
-            tf.summary.scalar("Val Kappa cost", val_kappa_cost, step=step)
-            tf.summary.scalar("Source cost", train_source_cost, step=step)
-            tf.summary.scalar("Val Source cost", val_source_cost, step=step)
-            tf.summary.scalar("MSE", train_cost, step=step)
-            tf.summary.scalar("Val MSE", val_cost, step=step)
-            tf.summary.scalar("Learning Rate", optim.lr(step), step=step)
-            tf.summary.scalar("Val Chi Squared", val_chi_sq, step=step)
-        print(f"epoch {epoch} | train loss {train_cost:.3e} | val loss {val_cost:.3e} "
-              f"| lr {optim.lr(step).numpy():.2e} | time per step {time_per_step.result().numpy():.2e} s"
-              f"| kappa cost {train_kappa_cost:.2e} | source cost {train_source_cost:.2e} | chi sq {train_chi_sq:.2e}")
-        history["train_cost"].append(train_cost)
-        history["val_cost"].append(val_cost)
-        history["learning_rate"].append(optim.lr(step).numpy())
-        history["train_chi_squared"].append(train_chi_sq)
-        history["val_chi_squared"].append(val_chi_sq)
-        history["time_per_step"].append(time_per_step.result().numpy())
-        history["train_kappa_cost"].append(train_kappa_cost)
-        history["train_source_cost"].append(train_source_cost)
-        history["val_kappa_cost"].append(val_kappa_cost)
-        history["val_source_cost"].append(val_source_cost)
-        history["step"].append(step)
-        history["wall_time"].append(time.time() - global_start)
-
-        cost = train_cost if args.track_train else val_cost
-        if np.isnan(cost):
-            print("Training broke the Universe")
-            break
-        if cost < (1 - args.tolerance) * best_loss:
-            best_loss = cost
-            patience = args.patience
-        else:
-            patience -= 1
-        if (time.time() - global_start) > args.max_time * 3600:
-            out_of_time = True
-        if save_checkpoint:
-            checkpoint_manager.checkpoint.step.assign_add(1) # a bit of a hack
-            if epoch % args.checkpoints == 0 or patience == 0 or epoch == args.epochs - 1 or out_of_time:
-                with open(os.path.join(checkpoints_dir, "score_sheet.txt"), mode="a") as f:
-                    np.savetxt(f, np.array([[lastest_checkpoint, cost]]))
-                lastest_checkpoint += 1
-                checkpoint_manager.save()
-                print("Saved checkpoint for step {}: {}".format(int(checkpoint_manager.checkpoint.step), checkpoint_manager.latest_checkpoint))
-        if patience == 0:
-            print("Reached patience")
-            break
-        if out_of_time:
-            break
-        if epoch > 0:  # First epoch is always very slow and not a good estimate of an epoch time.
-            estimated_time_for_epoch = time.time() - epoch_start
-        if optim.lr(step).numpy() < 1e-8:
-            print("Reached learning rate limit")
-            break
+            learning_rate = float(optim.lr(step).numpy())  # read the schedule once per epoch
+            # only the end of epoch logs go through the writer, the training loop runs outside of its context
+            with writer.as_default():
+                tf.summary.scalar("Time per step", time_per_step.result(), step=step)
+                tf.summary.scalar("Chi Squared", train_chi_sq, step=step)
+                tf.summary.scalar("Kappa cost", train_kappa_cost, step=step)
+                tf.summary.scalar("Val Kappa cost", val_kappa_cost, step=step)
+                tf.summary.scalar("Source cost", train_source_cost, step=step)
+                tf.summary.scalar("Val Source cost", val_source_cost, step=step)
+                tf.summary.scalar("MSE", train_cost, step=step)
+                tf.summary.scalar("Val MSE", val_cost, step=step)
+                tf.summary.scalar("Learning Rate", learning_rate, step=step)
+                tf.summary.scalar("Val Chi Squared", val_chi_sq, step=step)
+            writer.flush()
+            print(f"epoch {epoch} | train loss {train_cost:.3e} | val loss {val_cost:.3e} "
+                  f"| lr {learning_rate:.2e} | time per step {time_per_step.result().numpy():.2e} s"
+                  f"| kappa cost {train_kappa_cost:.2e} | source cost {train_source_cost:.2e} | chi sq {train_chi_sq:.2e}")
+            history["train_cost"].append(train_cost)
+            history["val_cost"].append(val_cost)
+            history["learning_rate"].append(learning_rate)
+            history["train_chi_squared"].append(train_chi_sq)
+            history["val_chi_squared"].append(val_chi_sq)
+            history["time_per_step"].append(time_per_step.result().numpy())
+            history["train_kappa_cost"].append(train_kappa_cost)
+            history["train_source_cost"].append(train_source_cost)
+            history["val_kappa_cost"].append(val_kappa_cost)
+            history["val_source_cost"].append(val_source_cost)
+            history["step"].append(step)
+            history["wall_time"].append(time.time() - global_start)
+
+            cost = train_cost if args.track_train else val_cost
+            if np.isnan(cost):
+                print("Training broke the Universe")
+                break
+            if cost < (1 - args.tolerance) * best_loss:
+                best_loss = cost
+                patience = args.patience
+            else:
+                patience -= 1
+            if (time.time() - global_start) > args.max_time * 3600:
+                out_of_time = True
+            if save_checkpoint:
+                checkpoint_manager.checkpoint.step.assign_add(1) # a bit of a hack
+                if epoch % args.checkpoints == 0 or patience == 0 or epoch == args.epochs - 1 or out_of_time:
+                    save_path = checkpoint_manager.save(options=checkpoint_options)
+                    # the row is written with its checkpoint, so the score sheet survives a job killed mid-run
+                    with open(os.path.join(checkpoints_dir, "score_sheet.txt"), mode="a") as f:
+                        np.savetxt(f, np.array([[lastest_checkpoint, cost]]))
+                    lastest_checkpoint += 1
+                    print("Saved checkpoint for step {}: {}".format(int(checkpoint_manager.checkpoint.step), save_path))
+            if patience == 0:
+                print("Reached patience")
+                break
+            if out_of_time:
+                break
+            if epoch > 0:  # First epoch is always very slow and not a good estimate of an epoch time.
+                estimated_time_for_epoch = time.time() - epoch_start
+            if learning_rate < 1e-8:
+                print("Reached learning rate limit")
+                break
+    finally:
+        plot_executor.shutdown(wait=True)
+    if plot_future is not None:
+        plot_future.result()
     print(f"Finished training after {(time.time() - global_start)/3600:.3f} hours.")
     return history, best_loss
 
 
 if __name__ == "__main__":
-    from argparse import ArgumentParser
-    parser = ArgumentParser()
+    parser = ArgumentParser(parents=[DEVICE_PARSER])
     parser.add_argument("--model_id",               default="None",                 help="Start from this model id checkpoint. None means start from scratch")
     parser.add_argument("--datasets",               required=True,  nargs="+",      help="Path to directories that contains tfrecords of dataset. Can be multiple inputs (space separated)")
     parser.add_argument("--val_datasets",           default=None,  nargs="+",       help="Validation dataset path")
@@ -544,13 +693,22 @@ if __name__ == "__main__":
     parser.add_argument("--raytracer",              default=None,                   help="Path to raytracer checkpoint dir if method 'unet' is used.")
 
     # Training set params
-    parser.add_argument("-b", "--batch_size",       default=1,      type=int,       help="Number of images in a batch. ")
+    parser.add_argument("-b", "--batch_size",       default=8,      type=int,       help="Number of images in a batch. ")
+    parser.add_argument("--grad_accum_steps",       default=1,      type=int,       help="Number of batches whose gradients are accumulated before an update. The effective batch size is batch_size * grad_accum_steps.")
     parser.add_argument("--train_split",            default=0.9,    type=float,     help="Fraction of the training set.")
     parser.add_argument("--total_items",            required=True,  type=int,       help="Total images in an epoch.")
     # ... for tfrecord dataset
     parser.add_argument("--cache_file",             default=None,                   help="Path to cache file, useful when training on server. Use ${SLURM_TMPDIR}/cache")
+    parser.add_argument("--snapshot_dir",           default=None,                   help="Directory where decoded examples are saved with tf.data snapshot, before caching.")
+    parser.add_argument("--snapshot_compression",   default="AUTO",                 help="Compression of the snapshot files, one of AUTO, GZIP, SNAPPY or None.")
+    parser.add_argument("--cache_policy",           default=None,   choices=["none", "memory", "file"], help="Where decoded examples are cached after the first epoch. Default is file when --cache_file is given, none otherwise.")
     parser.add_argument("--block_length",           default=1,      type=int,       help="Number of example to read from each files at a given moment.")
+    parser.add_argument("--cycle_length",           default=None,   type=int,       help="Number of files read concurrently. Default is the number of files, capped at the number of cpus.")
+    parser.add_argument("--num_parallel_calls",     default=-1,     type=int,       help="Parallelism of the file interleave and of the decoding map. Default (-1) lets tf.data autotune it.")
     parser.add_argument("--buffer_size",            default=1000,   type=int,       help="Buffer size for shuffling at each epoch.")
+    parser.add_argument("--deterministic",          action="store_true",            help="Keep the order of examples read from --datasets and --val_datasets. Splitting a single dataset is always deterministic.")
+    parser.add_argument("--tfdata_optimizations",   default="map_and_batch_fusion,map_fusion,parallel_batch", help="Comma separated tf.data static optimizations to enable.")
+    parser.add_argument("--prefetch_buffer",        default=-1,     type=int,       help="Number of batches prefetched at the end of the pipeline, after shuffling and batching. Default (-1) lets tf.data autotune it.")
 
     # Optimization params
     parser.add_argument("-e", "--epochs",           default=100,     type=int,       help="Number of epochs for training.")
@@ -559,29 +717,41 @@ if __name__ == "__main__":
     parser.add_argument("--decay_rate",             default=0.9,     type=float,    help="Exponential decay rate of learning rate (1=no decay).")
     parser.add_argument("--decay_steps",            default=100000,   type=int,     help="Decay steps of exponential decay of the learning rate.")
     parser.add_argument("--staircase",              action="store_true",            help="Learning rate schedule only change after decay steps if enabled.")
+    parser.add_argument("--clipnorm",               default=5.,     type=float,     help="Gradients are rescaled so that their global norm is at most this value.")
     parser.add_argument("--patience",               default=np.inf, type=int,       help="Number of step at which training is stopped if no improvement is recorder.")
     parser.add_argument("--tolerance",              default=0,      type=float,     help="Current score <= (1 - tolerance) * best score => reset patience, else reduce patience.")
     parser.add_argument("--track_train",            action="store_true",            help="Track training metric instead of validation metric, in case we want to overfit")
     parser.add_argument("--max_time",               default=np.inf, type=float,     help="Time allowed for the training, in hours.")
     parser.add_argument("--time_weights",           default="uniform",              help="uniform: w_t=1 for all t, linear: w_t~t, quadratic: w_t~t^2")
-    parser.add_argument("--unroll_time_steps",      action="store_true",            help="Unroll time steps of RIM in GPU usinf tf.function")
+    parser.add_argument("--num_gpus",               default=-1,     type=int,       help="Number of gpus the batches are split across. Default (-1) uses every visible gpu.")
+    parser.add_argument("--mixed_precision",        default="none",                 choices=["none", "mixed_float16", "mixed_bfloat16"],
+                                                                                    help="Keras mixed precision policy of the unet. The physical model and the cost stay in float32.")
+    parser.add_argument("--unroll_time_steps",      action="store_true", default=None, help="Unroll time steps of RIM in GPU usinf tf.function. Default is to unroll when steps <= 16.")
+    parser.add_argument("--no_unroll_time_steps",   action="store_false", dest="unroll_time_steps", help="Run the time steps of the RIM in a loop recorded by the outer tape.")
+    parser.add_argument("--compile_mode",           default="graph",                choices=["graph", "eager", "xla"], help="Execution mode of tf.function. xla also turns on XLA auto-clustering, eager is meant for debugging.")
+    parser.add_argument("--xla_auto_clustering",    action="store_true",            help="Turn on XLA auto-clustering. Mostly useful with the fft and conv2d forward methods.")
+    parser.add_argument("--no_jit_compile",         action="store_false", dest="jit_compile", help="Do not compile the residual costs with XLA. The RIM itself is never compiled, tfa resampler has no XLA kernel.")
     parser.add_argument("--reset_optimizer_states",  action="store_true",           help="When training from pre-trained weights, reset states of optimizer.")
     parser.add_argument("--kappa_residual_weights",         default="sqrt",         help="Options are ['uniform', 'linear', 'quadratic', 'sqrt']")
     parser.add_argument("--source_residual_weights",        default="uniform",      help="Options are ['uniform', 'linear', 'quadratic']")
 
     # logs
-    parser.add_argument("--logdir",                  default="None",                help="Path of logs directory. Default if None, no logs recorded.")
+    parser.add_argument("--logdir",                  default=None,                  help="Path of logs directory. Default if None, no logs recorded.")
     parser.add_argument("--logname",                 default=None,                  help="Overwrite name of the log with this argument")
     parser.add_argument("--logname_prefixe",         default="RIMSUv3",             help="If name of the log is not provided, this prefix is prepended to the date")
     parser.add_argument("--model_dir",               default="None",                help="Path to the directory where to save models checkpoints.")
     parser.add_argument("--checkpoints",             default=5,     type=int,       help="Save a checkpoint of the models each x epochs.")
+    parser.add_argument("--async_checkpoint",        action="store_true",           help="Write checkpoints on a background thread while training continues. Requires tensorflow >= 2.9.")
     parser.add_argument("--max_to_keep",             default=3,     type=int,       help="Max model checkpoint to keep.")
     parser.add_argument("--n_residuals",             default=1,     type=int,       help="Number of residual plots to save. Add overhead at the end of an epoch only.")
+    parser.add_argument("--residuals_every",         default=1,     type=int,       help="Save residual plots every x epochs. 0 means never.")
 
     # Reproducibility params
     parser.add_argument("--seed",                   default=None,   type=int,       help="Random seed for numpy and tensorflow.")
     parser.add_argument("--json_override",          default=None,    nargs="+",     help="A json filepath that will override every command line parameters. Useful for reproducibility")
 
     args = parser.parse_args()
+    if args.async_checkpoint and "experimental_enable_async_checkpoint" not in inspect.signature(tf.train.CheckpointOptions).parameters:
+        parser.error(f"--async_checkpoint requires tensorflow >= 2.9, found {tf.__version__}")
 
     main(args)
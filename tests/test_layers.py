@@ -0,0 +1,57 @@
+import numpy as np
+import tensorflow as tf
+from censai.models.layers import ConvEncodingLayer, ConvGRUBlock, ConvGRUPlusBlock
+from censai.models.layers.conv_gru import ConvGRU
+from censai.models.layers.conv_gru_plus import ConvGRUPlus
+
+
+def test_conv_encoding_layer_fuse_bn():
+    layer = ConvEncodingLayer(filters=8, conv_layers=2, activation="relu", batch_norm=True)
+    x = tf.random.normal([2, 16, 16, 3])
+    layer(x, training=True)  # build and move the batch norm statistics away from their initial values
+    for bn in list(layer.batch_norms) + [layer.downsampling_layer.batch_norm]:
+        bn.moving_mean.assign(tf.random.normal(bn.moving_mean.shape))
+        bn.moving_variance.assign(tf.random.uniform(bn.moving_variance.shape, 0.5, 2.))
+    expected = layer(x, training=False)
+    layer.fuse_bn()
+    fused = layer(x, training=False)
+    assert np.allclose(expected, fused, atol=1e-5)
+
+
+def test_conv_gru_blocks_tuple_state():
+    for block in [ConvGRUBlock(filters=4, kernel_size=3), ConvGRUPlusBlock(filters=4, kernel_size=3)]:
+        x = tf.random.normal([2, 8, 8, 4])
+        state = (tf.zeros([2, 8, 8, 4]), tf.zeros([2, 8, 8, 4]))
+        for _ in range(2):
+            xt, state = block(x, state)
+        assert xt.shape == [2, 8, 8, 4]
+        assert len(state) == 2 and all(ht.shape == [2, 8, 8, 4] for ht in state)
+
+
+class LegacyGRUBlock(tf.keras.Model):
+    # Layout of the recurrent blocks before conv1 was applied with raw ops
+    def __init__(self, gru, filters, kernel_size):
+        super(LegacyGRUBlock, self).__init__()
+        self.conv1 = tf.keras.layers.Conv2D(filters=filters, kernel_size=kernel_size, activation=tf.nn.tanh, padding='same')
+        self.gru1 = gru(filters, (kernel_size,) * 2)
+        self.gru2 = gru(filters, (kernel_size,) * 2)
+
+    def call(self, inputs, state):
+        ht_11, ht_12 = state
+        gru_1_out, _ = self.gru1(inputs, ht_11)
+        gru_2_out, _ = self.gru2(self.conv1(gru_1_out), ht_12)
+        return gru_2_out, (gru_1_out, gru_2_out)
+
+
+def test_conv_gru_blocks_restore_legacy_checkpoint(tmp_path):
+    for gru, block_class in [(ConvGRU, ConvGRUBlock), (ConvGRUPlus, ConvGRUPlusBlock)]:
+        x = tf.random.normal([2, 8, 8, 4])
+        state = (tf.random.normal([2, 8, 8, 4]), tf.random.normal([2, 8, 8, 4]))
+        legacy = LegacyGRUBlock(gru, filters=4, kernel_size=3)
+        expected, _ = legacy(x, state)
+        path = tf.train.Checkpoint(net=legacy).save(str(tmp_path / block_class.__name__))
+        block = block_class(filters=4, kernel_size=3)
+        status = tf.train.Checkpoint(net=block).restore(path)
+        xt, _ = block(x, state)
+        status.assert_consumed()
+        assert np.allclose(expected, xt, atol=1e-5)
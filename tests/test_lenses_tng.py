@@ -0,0 +1,58 @@
+import importlib.util
+import os
+import numpy as np
+import tensorflow as tf
+from censai.data.lenses_tng import encode_examples, parse_example
+from censai.data.lenses_tng.decode_lenses import decode_all
+
+spec = importlib.util.spec_from_file_location("split_lenses", os.path.join(os.path.dirname(__file__), os.pardir, "scripts", "split_lenses.py"))
+split_lenses = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(split_lenses)
+
+
+def legacy_record():
+    # records written by encode_examples have no "dtype" feature, their images are float32
+    images = {
+        "kappa": tf.random.uniform([1, 16, 16, 1], 0.1, 2.),
+        "galaxies": tf.random.uniform([1, 8, 8, 1], 0., 1.),
+        "lensed_images": tf.random.uniform([1, 16, 16, 1], 0., 1.),
+        "psf": tf.random.uniform([1, 5, 5, 1], 0., 1.),
+    }
+    record = encode_examples(**images, z_source=1., z_lens=0.5, image_fov=8., kappa_fov=8., source_fov=3.,
+                             noise_rms=np.array([0.01]), fwhm=np.array([0.1]))[0]
+    return record, {"kappa": images["kappa"][0], "source": images["galaxies"][0], "lens": images["lensed_images"][0], "psf": images["psf"][0]}
+
+
+def test_decode_legacy_record():
+    record, images = legacy_record()
+    example = decode_all(record)
+    assert example["dtype"] == tf.float32.as_datatype_enum
+    for key, image in images.items():
+        assert np.array_equal(example[key], image)
+
+
+def test_quantized_records_round_trip():
+    record, images = legacy_record()
+    for dtype, rtol in [(tf.float32, 0.), (tf.float16, 1e-3), (tf.bfloat16, 1e-2)]:
+        quantized = split_lenses.serialize(split_lenses.quantize(parse_example(record), dtype))
+        example = decode_all(quantized)
+        assert example["dtype"] == dtype.as_datatype_enum
+        for key, image in images.items():
+            assert example[key].dtype == tf.float32
+            assert np.allclose(example[key], image, rtol=rtol, atol=0.)
+        assert np.isclose(example["noise rms"], 0.01)
+
+
+def test_slurm_workers_cover_array_and_step_tasks(monkeypatch):
+    for key in ["SLURM_NTASKS", "SLURM_PROCID", "SLURM_ARRAY_TASK_COUNT", "SLURM_ARRAY_TASK_ID"]:
+        monkeypatch.delenv(key, raising=False)
+    assert split_lenses.slurm_workers() == (1, 1)
+    workers = []
+    monkeypatch.setenv("SLURM_NTASKS", "2")
+    monkeypatch.setenv("SLURM_ARRAY_TASK_COUNT", "3")
+    for array_id in range(1, 4):
+        for task_id in range(2):
+            monkeypatch.setenv("SLURM_ARRAY_TASK_ID", str(array_id))
+            monkeypatch.setenv("SLURM_PROCID", str(task_id))
+            workers.append(split_lenses.slurm_workers())
+    assert workers == [(6, i) for i in range(1, 7)]
@@ -0,0 +1,43 @@
+import importlib.util
+import os
+import numpy as np
+import pytest
+import tensorflow as tf
+
+spec = importlib.util.spec_from_file_location("train_rim", os.path.join(os.path.dirname(__file__), os.pardir, "scripts", "train_rim.py"))
+train_rim = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(train_rim)
+
+
+def test_accumulated_gradients_match_full_batch():
+    model = tf.keras.Sequential([tf.keras.layers.Dense(4, activation="tanh"), tf.keras.layers.Dense(1)])
+    model.build([None, 3])
+    x = tf.random.normal([8, 3])
+    y = tf.random.normal([8, 1])
+    traces = []
+
+    def gradient_step(x, y):
+        traces.append(x.shape)
+        with tf.GradientTape() as tape:
+            residuals = tf.square(model(x) - y)
+            cost = tf.reduce_mean(residuals)
+        gradient = tape.gradient(cost, model.trainable_variables)
+        return gradient, cost, tf.reduce_mean(tf.sqrt(residuals)), tf.reduce_mean(y), tf.reduce_mean(x)
+
+    full_gradient, *full_scores = gradient_step(x, y)
+    accumulate = tf.function(lambda x, y: train_rim.accumulate_gradients(gradient_step, model.trainable_variables, (x, y), 4))
+    traces.clear()
+    gradient, *scores = accumulate(x, y)
+    assert traces == [[2, 3]]  # every micro-batch runs in the same traced loop body
+    for g, full_g in zip(gradient, full_gradient):
+        assert np.allclose(g, full_g, atol=1e-6)
+    assert np.allclose(scores, full_scores, atol=1e-6)
+
+
+def test_check_batch_size():
+    train_rim.check_batch_size(train_items=16, batch_size=2, grad_accum_steps=2, num_replicas=2)
+    train_rim.check_batch_size(train_items=16, batch_size=1, grad_accum_steps=1, num_replicas=2)
+    with pytest.raises(ValueError, match="multiple of the number of replicas"):
+        train_rim.check_batch_size(train_items=16, batch_size=1, grad_accum_steps=2, num_replicas=2)
+    with pytest.raises(ValueError, match="smaller than a single batch"):
+        train_rim.check_batch_size(train_items=3, batch_size=2, grad_accum_steps=2, num_replicas=1)